@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import random
+import sys
+import timeit
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from process_xmltv import classifier
+
+CATEGORIES = ["Movie", "Film", "Series", "Episode", "News", "Sport", "Documentary", "Drama", "Comedy", "Kids",
+              "Entertainment", "Talk Show", "Cinema", "Telefilm", "Music"]
+
+def build_programmes(count):
+    random.seed(0)
+    programmes = []
+    for index in range(count):
+        element = etree.Element("programme", start="20200101203000 +0100", stop="20200101{:02d}3000 +0100".format(21 + index % 3))
+        for category in random.sample(CATEGORIES, random.randint(1, 3)):
+            etree.SubElement(element, "category").text = category
+        if index % 4 == 0:
+            etree.SubElement(element, "credits")
+        if index % 5 == 0:
+            etree.SubElement(element, "episode-num").text = "S01E01"
+        programmes.append(element)
+    return programmes
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser._action_groups.pop()
+    optional = argParser.add_argument_group('optional arguments')
+    optional.add_argument("-n", "--programmes", type=int, default=10000, help="Number of programmes to classify (Default: 10000)")
+    optional.add_argument("-r", "--repeat", type=int, default=5, help="Number of runs, best is reported (Default: 5)")
+    optional.add_argument("-m", "--categories", type=str, help="JSON file mapping categories to a programme type")
+    args = argParser.parse_args()
+
+    programmes = build_programmes(count=args.programmes)
+    programmeClassifier = classifier(mappingFile=args.categories)
+
+    def classify():
+        for programme in programmes:
+            programmeClassifier.get_programme_type(element=programme)
+
+    best = min(timeit.repeat(classify, number=1, repeat=args.repeat))
+    print("Classified {} programmes in {:.3f}s - {:.2f}us per programme".format(args.programmes, best, best / args.programmes * 1000000))
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+# Benchmark of process_xmltv. TMDB responses are replayed from recorded fixtures (or generated by the synthetic
+# catalogue) and elasticsearch is the in memory stand-in, or a local elasticsearch with --es-host. Each file is
+# processed twice: a cold pass with empty indices and caches, and a warm pass reusing the records and caches of the
+# cold pass. Each file is processed in a forked process, so that the peak RSS of a file does not include earlier files
+
+benchmarksDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarksDir))
+os.environ.setdefault("TMDB_API_KEY", "benchmark")
+
+import elasticsearch
+import elastictmdb.bulk
+import elastictmdb.movie
+import process_xmltv
+from elasticsearch import helpers
+from elastictmdb.metrics import registry
+from elastictmdb.tmdb import TMDB
+from fake_es import FakeElasticsearch, FakeHelpers
+from fake_tmdb import ReplayAdapter, SyntheticCatalogue
+from generate_xmltv import SIZES, generator, get_filename
+
+class CountingClient(object):
+    # Proxy counting the requests sent to elasticsearch by method
+    methods = {"search", "msearch", "get", "mget", "bulk", "exists", "create", "refresh", "delete"}
+
+    def __init__(self, client, calls, prefix=""):
+        self.client = client
+        self.calls = calls
+        self.prefix = prefix
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name == "indices":
+            return CountingClient(client=attribute, calls=self.calls, prefix="indices.")
+        if name not in self.methods:
+            return attribute
+        def method(*args, **kwargs):
+            self.calls["{}{}".format(self.prefix, name)] += 1
+            return attribute(*args, **kwargs)
+        return method
+
+class CountingHelpers(object):
+    # Bulk helper of the elasticsearch client, counting a request per chunk of records
+    def bulk(self, client, actions, **kwargs):
+        actions = list(actions)
+        client.calls["bulk"] += max(1, -(-len(actions) // kwargs.get("chunk_size", 500)))
+        return helpers.bulk(client.client, actions, **kwargs)
+
+def reset_peak_rss():
+    # Reset the peak RSS of the process to the current RSS (Linux 4.0 and later). Returns False if not supported
+    try:
+        with open("/proc/self/clear_refs", "w") as clearRefsFile:
+            clearRefsFile.write("5")
+        return True
+    except OSError:
+        return False
+
+def get_peak_rss(reset):
+    # Peak RSS in MB since the last reset, or of the process so far if the peak could not be reset
+    if reset:
+        with open("/proc/self/status") as statusFile:
+            for line in statusFile:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+class benchmark(object):
+    def __init__(self, esHost=None, fixturesDir=None, record=False, seed=0, concurrency=8):
+        self.esHost = esHost
+        self.concurrency = concurrency
+        self.esCalls = collections.Counter()
+        self.es = None
+        self.cacheDir = None
+        self.adapter = ReplayAdapter(fixturesDir=fixturesDir, catalogue=None if record else SyntheticCatalogue(seed=seed), record=record)
+        self.patch()
+
+    def patch(self):
+        # ElasticTMDB objects created by process_xmltv use the stand-ins and a temporary cache directory
+        benchmarkObj = self
+        # Title classes import the package as elastictmdb.__init__, so the module they were defined in is patched
+        titleModule = sys.modules[elastictmdb.movie.ElasticTMDB.__module__]
+        setDefaults = titleModule.set_defaults
+        def set_defaults(titleObj):
+            setDefaults(titleObj)
+            titleObj.config["cache_dir"] = benchmarkObj.cacheDir
+            titleObj.config["negative_cache_file"] = os.path.join(benchmarkObj.cacheDir, "negative.sqlite")
+            titleObj.config["tmdb_cache_file"] = None
+            titleObj.config["tmdb_rate_limit"] = None
+            if benchmarkObj.esHost:
+                titleObj.config["index_prefix"] = "benchmark"
+        titleModule.set_defaults = set_defaults
+
+        tmdbInit = TMDB.__init__
+        def tmdb_init(tmdbObj, *args, **kwargs):
+            tmdbInit(tmdbObj, *args, **kwargs)
+            tmdbObj.session.mount(tmdbObj.baseUrl, benchmarkObj.adapter)
+        TMDB.__init__ = tmdb_init
+
+        elasticsearchClient = elasticsearch.Elasticsearch
+        def get_client(**kwargs):
+            if benchmarkObj.esHost:
+                return CountingClient(client=elasticsearchClient(hosts=[benchmarkObj.esHost]), calls=benchmarkObj.esCalls)
+            return CountingClient(client=benchmarkObj.es, calls=benchmarkObj.esCalls)
+        elasticsearch.Elasticsearch = get_client
+        elastictmdb.bulk.helpers = CountingHelpers() if self.esHost else FakeHelpers()
+
+    def reset(self):
+        # Empty indices and caches before the cold pass
+        if self.cacheDir:
+            shutil.rmtree(self.cacheDir, ignore_errors=True)
+        self.cacheDir = tempfile.mkdtemp(prefix="elastictmdb_benchmark_")
+        if self.esHost:
+            elasticsearch.Elasticsearch(hosts=[self.esHost]).indices.delete(index="benchmark_*")
+        else:
+            self.es = FakeElasticsearch()
+
+    def run_pass(self, filename, passName):
+        registry.collect(reset=True)
+        self.esCalls.clear()
+        self.adapter.calls.clear()
+        peakReset = reset_peak_rss()
+
+        startTime = time.perf_counter()
+        epg = process_xmltv.epg(concurrency=self.concurrency)
+        epg.open_file(os.path.join(self.cacheDir, "output.xml"))
+        epg.process_channels(filename)
+        epg.process_file(filename)
+        epg.save_file()
+        duration = time.perf_counter() - startTime
+        epg.executor.shutdown()
+
+        counters = registry.collect()["counters"]
+        programmes = counters.get("programmes", 0)
+        esCalls = sum(self.esCalls.values())
+        tmdbCalls = sum(self.adapter.calls.values())
+        result = {}
+        result["file"] = os.path.basename(filename)
+        result["pass"] = passName
+        result["programmes"] = programmes
+        result["programmes_searched"] = counters.get("programmes_searched", 0)
+        result["seconds"] = round(duration, 3)
+        result["programmes_per_s"] = round(programmes / duration, 1) if duration else 0.0
+        result["es_calls"] = esCalls
+        result["es_calls_per_programme"] = round(esCalls / programmes, 3) if programmes else 0.0
+        result["tmdb_calls"] = tmdbCalls
+        result["tmdb_calls_per_programme"] = round(tmdbCalls / programmes, 3) if programmes else 0.0
+        result["peak_rss_mb"] = get_peak_rss(reset=peakReset)
+        result["es_calls_by_method"] = dict(self.esCalls.most_common())
+        result["tmdb_calls_by_endpoint"] = dict(self.adapter.calls.most_common())
+        return result
+
+    def run(self, filename):
+        # Results, or the traceback if the file could not be processed, are sent back by the forked process
+        context = multiprocessing.get_context("fork")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=self.run_process, args=(filename, sender))
+        process.start()
+        sender.close()
+        try:
+            results = receiver.recv()
+        except EOFError:
+            results = None
+        process.join()
+        if results is None:
+            results = "Process exited with code {}".format(process.exitcode)
+        if isinstance(results, str):
+            raise RuntimeError("Benchmark of {} failed\n{}".format(filename, results))
+        return results
+
+    def run_process(self, filename, sender):
+        try:
+            self.reset()
+            sender.send([self.run_pass(filename=filename, passName="cold"), self.run_pass(filename=filename, passName="warm")])
+        except Exception:
+            sender.send(traceback.format_exc())
+        finally:
+            sender.close()
+            if self.cacheDir:
+                shutil.rmtree(self.cacheDir, ignore_errors=True)
+
+    def close(self):
+        if self.cacheDir:
+            shutil.rmtree(self.cacheDir, ignore_errors=True)
+        self.adapter.close()
+
+def print_results(results):
+    columns = [("file", "{:<22}"), ("pass", "{:<5}"), ("programmes", "{:>10}"), ("seconds", "{:>9}"), ("programmes_per_s", "{:>12}"),
+               ("es_calls_per_programme", "{:>12}"), ("tmdb_calls_per_programme", "{:>12}"), ("peak_rss_mb", "{:>8}")]
+    headers = ["File", "Pass", "Programmes", "Seconds", "Prog/s", "ES/prog", "TMDB/prog", "RSS MB"]
+    print(" ".join(fmt.format(header) for header, (name, fmt) in zip(headers, columns)))
+    for result in results:
+        print(" ".join(fmt.format(result[name]) for name, fmt in columns))
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser._action_groups.pop()
+    optional = argParser.add_argument_group('optional arguments')
+    optional.add_argument("-i", "--input", type=str, action="append", help="XMLTV file to process, can be repeated (Default: generated files of the given sizes)")
+    optional.add_argument("-s", "--size", type=str, action="append", choices=list(SIZES), help="Size of the generated file to process, can be repeated (Default: 1k and 10k)")
+    optional.add_argument("-c", "--concurrency", type=int, default=8, help="Number of programmes to search concurrently (Default: 8)")
+    optional.add_argument("-e", "--es-host", type=str, help="Use the elasticsearch at this URL instead of the in memory stand-in. Indices are prefixed with benchmark and deleted first")
+    optional.add_argument("-f", "--fixtures", type=str, default=os.path.join(benchmarksDir, "fixtures"), help="Directory of TMDB responses recorded with -r, none are shipped (Default: benchmarks/fixtures)")
+    optional.add_argument("-r", "--record", action="store_true", help="Send requests to TMDB (TMDB_API_KEY has to be set) and save the responses to the fixtures directory")
+    optional.add_argument("-o", "--output", type=str, help="Save the results as JSON to file")
+    optional.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic catalogue and generated files (Default: 0)")
+    optional.add_argument("-d", "--debug", action="store_true", help="Enable debug")
+    args = argParser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING, format="%(asctime)s %(message)s")
+
+    if not args.record and not os.path.isdir(args.fixtures):
+        logging.warning("No TMDB responses recorded in {}, requests are answered by the synthetic catalogue (record them with -r)".format(args.fixtures))
+
+    inputFiles = args.input or []
+    if not args.input:
+        dataDir = os.path.join(benchmarksDir, "data")
+        os.makedirs(dataDir, exist_ok=True)
+        catalogue = SyntheticCatalogue(seed=args.seed)
+        for size in args.size or ["1k", "10k"]:
+            filename = get_filename(dataDir=dataDir, size=size)
+            # Generated files are reused, delete them to generate them again
+            if not os.path.exists(filename):
+                generator(catalogue=catalogue, seed=args.seed).write_file(filename=filename, programmes=SIZES[size])
+            inputFiles.append(filename)
+
+    benchmarkObj = benchmark(esHost=args.es_host, fixturesDir=args.fixtures, record=args.record, seed=args.seed, concurrency=args.concurrency)
+    results = []
+    try:
+        for filename in inputFiles:
+            results.extend(benchmarkObj.run(filename=filename))
+    finally:
+        benchmarkObj.close()
+
+    print_results(results=results)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(results, outputFile, indent=2)
@@ -0,0 +1,362 @@
+import collections
+import copy
+import functools
+import json
+import re
+import threading
+import uuid
+import elasticsearch
+
+# In memory stand-in for the subset of the elasticsearch API used by ElasticTMDB: indices exists/create/refresh/delete,
+# search (bool, term, range, match and multi_match queries with a terms aggregation of top hits), msearch, get, mget
+# and bulk. Scores only approximate the ones of elasticsearch, high enough for exact titles to be accepted without
+# searching TMDB and low enough for partial matches to go through the full search
+
+class NotFoundError(elasticsearch.NotFoundError):
+    def __init__(self, index, recordId):
+        Exception.__init__(self, "{} not found in {}".format(recordId, index))
+
+    def __str__(self):
+        return self.args[0]
+
+@functools.lru_cache(maxsize=100000)
+def tokenize(text):
+    # Titles and names are searched many times, so their tokens are only computed once
+    return frozenset(re.findall(r"\w+", str(text).casefold()))
+
+def get_values(source, field):
+    # Values of a dotted field, lists are flattened
+    values = [source]
+    for name in field.split("."):
+        nextValues = []
+        for value in values:
+            if isinstance(value, dict) and name in value:
+                value = value[name]
+                if isinstance(value, list):
+                    nextValues.extend(value)
+                else:
+                    nextValues.append(value)
+        values = nextValues
+    return values
+
+def get_leaves(source, prefix=""):
+    for name, value in source.items():
+        field = "{}{}".format(prefix, name)
+        if isinstance(value, dict):
+            yield from get_leaves(source=value, prefix="{}.".format(field))
+        elif isinstance(value, list):
+            for item in value:
+                if not isinstance(item, (dict, list)):
+                    yield field, item
+        else:
+            yield field, value
+
+class FakeIndex(object):
+    def __init__(self):
+        self.records = {}
+        # Record IDs by field and value for term queries, and by field and token for match queries
+        self.terms = collections.defaultdict(set)
+        self.tokens = collections.defaultdict(set)
+        # Values of the fields queried, by record ID and field
+        self.values = {}
+
+    def get_values(self, recordId, field):
+        values = self.values.setdefault(recordId, {})
+        if field not in values:
+            values[field] = get_values(source=self.records[recordId], field=field)
+        return values[field]
+
+    def add(self, recordId, source):
+        self.remove(recordId=recordId)
+        self.records[recordId] = source
+        for field, value in get_leaves(source=source):
+            self.terms[(field, value)].add(recordId)
+            if isinstance(value, str):
+                self.terms[("{}.keyword".format(field), value.casefold())].add(recordId)
+                for token in tokenize(value):
+                    self.tokens[(field, token)].add(recordId)
+
+    def remove(self, recordId):
+        source = self.records.pop(recordId, None)
+        self.values.pop(recordId, None)
+        if source is None:
+            return False
+        for field, value in get_leaves(source=source):
+            self.terms[(field, value)].discard(recordId)
+            if isinstance(value, str):
+                self.terms[("{}.keyword".format(field), value.casefold())].discard(recordId)
+                for token in tokenize(value):
+                    self.tokens[(field, token)].discard(recordId)
+        return True
+
+class FakeIndices(object):
+    def __init__(self, es):
+        self.es = es
+
+    def exists(self, index):
+        self.es.count_call(name="indices.exists")
+        return index in self.es.indices_data
+
+    def create(self, index, body=None):
+        self.es.count_call(name="indices.create")
+        with self.es.lock:
+            self.es.indices_data.setdefault(index, FakeIndex())
+        return {"acknowledged": True}
+
+    def refresh(self, index):
+        # Records are visible as soon as they are written
+        self.es.count_call(name="indices.refresh")
+        return {}
+
+    def delete(self, index):
+        self.es.count_call(name="indices.delete")
+        with self.es.lock:
+            pattern = re.compile("^{}$".format(re.escape(index).replace(r"\*", ".*")))
+            for indexName in [indexName for indexName in self.es.indices_data if pattern.match(indexName)]:
+                del self.es.indices_data[indexName]
+        return {"acknowledged": True}
+
+class FakeElasticsearch(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.indices_data = {}
+        self.indices = FakeIndices(es=self)
+        self.calls = collections.Counter()
+
+    def count_call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def get_index(self, index):
+        if index not in self.indices_data:
+            self.indices_data[index] = FakeIndex()
+        return self.indices_data[index]
+
+    def search(self, index, body):
+        self.count_call(name="search")
+        with self.lock:
+            return self.run_search(index=index, body=body)
+
+    def msearch(self, body):
+        self.count_call(name="msearch")
+        responses = []
+        with self.lock:
+            for header, query in zip(body[0::2], body[1::2]):
+                responses.append(self.run_search(index=header["index"], body=query))
+        return {"responses": responses}
+
+    def get(self, index, id):
+        self.count_call(name="get")
+        with self.lock:
+            source = self.get_index(index=index).records.get(id)
+            if source is None:
+                raise NotFoundError(index=index, recordId=id)
+            return {"_index": index, "_id": id, "found": True, "_source": copy.deepcopy(source)}
+
+    def mget(self, index, body):
+        self.count_call(name="mget")
+        docs = []
+        with self.lock:
+            records = self.get_index(index=index).records
+            for recordId in body["ids"]:
+                if recordId in records:
+                    docs.append({"_index": index, "_id": recordId, "found": True, "_source": copy.deepcopy(records[recordId])})
+                else:
+                    docs.append({"_index": index, "_id": recordId, "found": False})
+        return {"docs": docs}
+
+    def bulk(self, body=None, operations=None, **kwargs):
+        # Operations as a list of actions and sources, or as newline delimited JSON
+        self.count_call(name="bulk")
+        operations = operations if operations is not None else body
+        if isinstance(operations, (str, bytes)):
+            operations = operations.decode("utf-8") if isinstance(operations, bytes) else operations
+            operations = [json.loads(line) for line in operations.splitlines() if line.strip()]
+        operations = [json.loads(operation) if isinstance(operation, (str, bytes)) else operation for operation in operations]
+
+        items = []
+        with self.lock:
+            position = 0
+            while position < len(operations):
+                opType, action = next(iter(operations[position].items()))
+                index = self.get_index(index=action["_index"])
+                recordId = action.get("_id") or uuid.uuid4().hex
+                if opType == "delete":
+                    found = index.remove(recordId=recordId)
+                    items.append({opType: {"_index": action["_index"], "_id": recordId, "status": 200 if found else 404}})
+                    position += 1
+                else:
+                    created = recordId not in index.records
+                    index.add(recordId=recordId, source=copy.deepcopy(operations[position + 1]))
+                    items.append({opType: {"_index": action["_index"], "_id": recordId, "status": 201 if created else 200}})
+                    position += 2
+        return {"errors": False, "items": items}
+
+    def run_search(self, index, body):
+        index = self.get_index(index=index)
+        query = body.get("query") or {"match_all": {}}
+        candidates = self.get_candidates(index=index, query=query)
+        if candidates is None:
+            candidates = index.records.keys()
+
+        hits = []
+        for recordId in candidates:
+            matched, score = self.evaluate(index=index, recordId=recordId, query=query)
+            if matched:
+                hits.append({"_index": body.get("index"), "_id": recordId, "_score": score, "_source": index.records[recordId]})
+        hits.sort(key=lambda hit: (-hit["_score"], hit["_id"]))
+
+        result = {"hits": {"total": {"value": len(hits)}, "hits": []}}
+        start = body.get("from", 0)
+        for hit in hits[start:start + body.get("size", 10)]:
+            result["hits"]["hits"].append(dict(hit, _source=copy.deepcopy(hit["_source"])))
+        if "aggs" in body:
+            result["aggregations"] = self.run_aggregations(hits=hits, aggs=body["aggs"])
+        return result
+
+    def run_aggregations(self, hits, aggs):
+        # Terms aggregations with top hits sub aggregations
+        aggregations = {}
+        for name, agg in aggs.items():
+            if "terms" in agg:
+                buckets = collections.OrderedDict()
+                for hit in hits:
+                    for value in get_values(source=hit["_source"], field=agg["terms"]["field"]):
+                        buckets.setdefault(value, []).append(hit)
+                ordered = sorted(buckets.items(), key=lambda bucket: -len(bucket[1]))[:agg["terms"].get("size", 10)]
+                aggregations[name] = {"buckets": []}
+                for key, bucketHits in ordered:
+                    bucket = {"key": key, "doc_count": len(bucketHits)}
+                    bucket.update(self.run_aggregations(hits=bucketHits, aggs=agg.get("aggs", {})))
+                    aggregations[name]["buckets"].append(bucket)
+            elif "top_hits" in agg:
+                topHits = [dict(hit, _source=copy.deepcopy(hit["_source"])) for hit in hits[:agg["top_hits"].get("size", 3)]]
+                aggregations[name] = {"hits": {"total": {"value": len(hits)}, "hits": topHits}}
+        return aggregations
+
+    def get_candidates(self, index, query):
+        # Record IDs which can match the query, None if any record can match
+        queryType, clause = next(iter(query.items()))
+        if queryType == "term":
+            field, value = next(iter(clause.items()))
+            return index.terms.get((field, value), set())
+        elif queryType == "match":
+            field, text = next(iter(clause.items()))
+            return self.get_token_candidates(index=index, fields=[field], text=text)
+        elif queryType == "multi_match":
+            return self.get_token_candidates(index=index, fields=clause["fields"], text=clause["query"])
+        elif queryType == "range":
+            # Small ranges of integers (years) are looked up value by value
+            field, bounds = next(iter(clause.items()))
+            lower, upper = bounds.get("gte"), bounds.get("lte")
+            if isinstance(lower, int) and isinstance(upper, int) and upper - lower <= 100:
+                return set().union(*[index.terms.get((field, value), set()) for value in range(lower, upper + 1)])
+        elif queryType == "bool":
+            mustSets = [candidates for candidates in (self.get_candidates(index=index, query=must) for must in clause.get("must", [])) if candidates is not None]
+            if mustSets:
+                return set.intersection(*[set(candidates) for candidates in mustSets])
+            # Should clauses are optional when there are must clauses
+            if clause.get("must"):
+                return None
+            shouldSets = [self.get_candidates(index=index, query=should) for should in clause.get("should", [])]
+            if shouldSets and None not in shouldSets:
+                return set().union(*shouldSets)
+        return None
+
+    def get_token_candidates(self, index, fields, text):
+        candidates = set()
+        for field in fields:
+            if field.endswith(".keyword"):
+                candidates |= index.terms.get((field, str(text).casefold()), set())
+            else:
+                for token in tokenize(text):
+                    candidates |= index.tokens.get((field, token), set())
+        return candidates
+
+    def evaluate(self, index, recordId, query):
+        queryType, clause = next(iter(query.items()))
+        if queryType == "match_all":
+            return True, 1.0
+        elif queryType == "term":
+            field, value = next(iter(clause.items()))
+            return value in index.get_values(recordId=recordId, field=field), 1.0
+        elif queryType == "range":
+            field, bounds = next(iter(clause.items()))
+            return any(self.in_range(value=value, bounds=bounds) for value in index.get_values(recordId=recordId, field=field)), 1.0
+        elif queryType == "match":
+            field, text = next(iter(clause.items()))
+            score = self.match_score(index=index, recordId=recordId, fields=[field], text=text, weight=10)
+            return score > 0, score
+        elif queryType == "multi_match":
+            score = self.match_score(index=index, recordId=recordId, fields=clause["fields"], text=clause["query"], weight=30)
+            return score > 0, score
+        elif queryType == "bool":
+            score = 0.0
+            for must in clause.get("must", []):
+                matched, mustScore = self.evaluate(index=index, recordId=recordId, query=must)
+                if not matched:
+                    return False, 0.0
+                score += mustScore
+            shouldMatched = False
+            for should in clause.get("should", []):
+                matched, shouldScore = self.evaluate(index=index, recordId=recordId, query=should)
+                if matched:
+                    shouldMatched = True
+                    score += shouldScore
+            if clause.get("should") and not clause.get("must") and not shouldMatched:
+                return False, 0.0
+            return True, score
+        raise ValueError("Query {} not supported".format(queryType))
+
+    def match_score(self, index, recordId, fields, text, weight):
+        # Fraction of the query tokens found in the best field, with a bonus for an exact match
+        queryTokens = tokenize(text)
+        best = 0.0
+        for field in fields:
+            exact = field.endswith(".keyword")
+            for value in index.get_values(recordId=recordId, field=field[:-len(".keyword")] if exact else field):
+                if not isinstance(value, str):
+                    continue
+                if exact:
+                    if value.casefold() == str(text).casefold():
+                        best = max(best, 10.0)
+                    continue
+                valueTokens = tokenize(value)
+                if queryTokens and valueTokens:
+                    score = weight * len(queryTokens & valueTokens) / len(queryTokens | valueTokens)
+                    if value.casefold() == str(text).casefold():
+                        score += weight / 2
+                    best = max(best, score)
+        return best
+
+    def in_range(self, value, bounds):
+        # Dates are compared by year, as with the yyyy||/y bounds used by episode queries
+        def to_year(bound):
+            return int(str(bound).split("||")[0][:4])
+        if isinstance(value, str) or any("||" in str(bound) for bound in bounds.values()):
+            try:
+                value = to_year(value)
+            except ValueError:
+                return False
+            lower = to_year(bounds["gte"]) if "gte" in bounds else None
+            upper = to_year(bounds["lte"]) if "lte" in bounds else None
+        else:
+            lower = bounds.get("gte")
+            upper = bounds.get("lte")
+        if value is None:
+            return False
+        return (lower is None or value >= lower) and (upper is None or value <= upper)
+
+class FakeHelpers(object):
+    # Replaces elasticsearch.helpers.bulk for the stand-in, which does not implement the transport used by the helpers
+    def bulk(self, client, actions, stats_only=False, raise_on_error=True, raise_on_exception=True, **kwargs):
+        operations = []
+        for action in actions:
+            header = {key: action[key] for key in ["_index", "_id"] if key in action}
+            operations.append({action.get("_op_type", "index"): header})
+            if action.get("_op_type", "index") != "delete":
+                operations.append(action["_source"])
+        response = client.bulk(operations=operations)
+        success = len([item for item in response["items"] if next(iter(item.values()))["status"] < 300])
+        errors = [item for item in response["items"] if next(iter(item.values()))["status"] >= 300]
+        return success, (len(errors) if stats_only else errors)
@@ -0,0 +1,237 @@
+import collections
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib.parse import parse_qsl, urlparse
+
+# Fake HTTP layer for TMDB requests. Responses are replayed from recorded fixtures and, for requests which were not
+# recorded, generated from a synthetic catalogue of movies, TV shows and people so that benchmarks run offline. In
+# record mode requests are sent to TMDB and the responses saved as fixtures
+
+WORDS = ["night", "city", "last", "dark", "love", "river", "king", "star", "dead", "blue", "house", "road", "secret",
+         "storm", "winter", "summer", "black", "red", "island", "shadow", "fire", "ghost", "golden", "lost", "silent",
+         "wild", "empire", "garden", "ocean", "stone", "iron", "glass", "broken", "hidden", "final", "long", "little",
+         "great", "white", "cold", "edge", "heart", "blood", "dream", "sky", "moon", "sun", "world", "time", "man",
+         "woman", "girl", "boy", "war", "game", "hunter", "doctor", "angel", "devil", "queen", "crown", "bridge",
+         "station", "forest", "mountain", "valley", "harbor", "castle", "tower", "street", "line", "circle", "code"]
+FIRST_NAMES = ["John", "Mary", "James", "Anna", "Robert", "Laura", "Michael", "Sarah", "David", "Emma", "Paul",
+               "Julia", "Peter", "Clara", "Mark", "Sofia", "Luca", "Marta", "Thomas", "Elena"]
+LAST_NAMES = ["Smith", "Rossi", "Brown", "Muller", "Garcia", "Martin", "Wilson", "Bianchi", "Moore", "Taylor",
+              "Anderson", "Lopez", "Clark", "Lewis", "Walker", "Young", "Hall", "Allen", "King", "Wright"]
+GENRES = {28: "Action", 12: "Adventure", 35: "Comedy", 80: "Crime", 18: "Drama", 14: "Fantasy", 27: "Horror",
+          9648: "Mystery", 10749: "Romance", 878: "Science Fiction", 53: "Thriller", 37: "Western"}
+COUNTRIES = {"US": "United States of America", "GB": "United Kingdom", "IT": "Italy", "FR": "France",
+             "DE": "Germany", "ES": "Spain"}
+LANGUAGES = {"en": "English", "it": "Italian", "fr": "French", "de": "German", "es": "Spanish"}
+
+class SyntheticCatalogue(object):
+    def __init__(self, movies=2000, tvshows=500, people=1000, seed=0):
+        rand = random.Random(seed)
+        self.people = {}
+        peopleNames = set()
+        while len(self.people) < people:
+            name = "{} {}".format(rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES))
+            if name in peopleNames:
+                name = "{} {}".format(name, rand.choice(LAST_NAMES))
+            if name in peopleNames:
+                continue
+            peopleNames.add(name)
+            self.people[len(self.people) + 1] = {"id": len(self.people) + 1, "name": name}
+
+        titles = set()
+        def new_title():
+            while True:
+                title = " ".join(rand.choice(WORDS) for index in range(rand.randint(1, 4))).title()
+                if title not in titles:
+                    titles.add(title)
+                    return title
+
+        self.titles = {"movie": collections.OrderedDict(), "tv": collections.OrderedDict()}
+        self.credits = {"movie": collections.defaultdict(list), "tv": collections.defaultdict(list)}
+        for titleType, count, firstId in [("movie", movies, 1), ("tv", tvshows, 100001)]:
+            for titleId in range(firstId, firstId + count):
+                title = {}
+                title["id"] = titleId
+                title["name"] = new_title()
+                title["original_language"] = rand.choice(["en", "en", "en", "it", "fr"])
+                title["original_name"] = title["name"] if title["original_language"] == "en" else new_title()
+                title["year"] = rand.randint(1950, 2020)
+                title["date"] = "{}-{:02d}-{:02d}".format(title["year"], rand.randint(1, 12), rand.randint(1, 28))
+                title["genres"] = rand.sample(sorted(GENRES), rand.randint(1, 3))
+                title["countries"] = rand.sample(sorted(COUNTRIES), rand.randint(1, 2))
+                title["popularity"] = round(rand.paretovariate(1.5), 3)
+                title["cast"] = rand.sample(sorted(self.people), 12)
+                title["director"] = rand.choice(sorted(self.people))
+                title["translations"] = [(language, new_title()) for language in rand.sample(sorted(LANGUAGES), 2)]
+                if titleType == "tv":
+                    title["seasons"] = rand.randint(1, 5)
+                    title["episodes"] = rand.randint(6, 13)
+                self.titles[titleType][titleId] = title
+                for personId in title["cast"] + [title["director"]]:
+                    self.credits[titleType][personId].append(titleId)
+
+    def get_attrib(self, titleType):
+        if titleType == "movie":
+            return {"title": "title", "original_title": "original_title", "date": "release_date", "alt_titles": "titles"}
+        return {"title": "name", "original_title": "original_name", "date": "first_air_date", "alt_titles": "results"}
+
+    def get_summary(self, titleType, title):
+        attrib = self.get_attrib(titleType=titleType)
+        summary = {"id": title["id"], "original_language": title["original_language"], "popularity": title["popularity"]}
+        summary[attrib["title"]] = title["name"]
+        summary[attrib["original_title"]] = title["original_name"]
+        summary[attrib["date"]] = title["date"]
+        # Person credits of TV shows are filtered by release_date
+        summary["release_date"] = title["date"]
+        return summary
+
+    def get_details(self, titleType, title):
+        attrib = self.get_attrib(titleType=titleType)
+        details = self.get_summary(titleType=titleType, title=title)
+        if titleType == "tv":
+            del details["release_date"]
+        details["genres"] = [{"id": genreId, "name": GENRES[genreId]} for genreId in title["genres"]]
+        if titleType == "movie":
+            details["production_countries"] = [{"iso_3166_1": country} for country in title["countries"]]
+        else:
+            details["origin_country"] = title["countries"]
+        details["vote_count"] = int(title["popularity"] * 100)
+        details["vote_average"] = round(5 + title["popularity"] % 5, 1)
+        details["overview"] = "A {} story about {}.\n\nMore details.".format(GENRES[title["genres"][0]].lower(), title["name"].lower())
+        details["tagline"] = ""
+        details["credits"] = self.get_credits(title=title)
+        details["translations"] = {"translations": [{"iso_639_1": language, "data": {attrib["title"]: name}} for language, name in title["translations"]]}
+        details["alternative_titles"] = {attrib["alt_titles"]: [{"iso_3166_1": "US", "title": title["name"].upper()}]}
+        details["images"] = self.get_images(title=title)
+        return details
+
+    def get_credits(self, title):
+        cast = [{"name": self.people[personId]["name"], "order": order} for order, personId in enumerate(title["cast"])]
+        crew = [{"name": self.people[title["director"]]["name"], "job": "Director"}]
+        return {"cast": cast, "crew": crew}
+
+    def get_images(self, title):
+        return {"posters": [{"aspect_ratio": 0.667, "file_path": "/{}.jpg".format(title["id"])}], "backdrops": []}
+
+    def get_season(self, title, season):
+        episodes = []
+        for episode in range(1, title["episodes"] + 1):
+            episodeRecord = {}
+            episodeRecord["id"] = title["id"] * 1000 + season * 100 + episode
+            episodeRecord["episode_number"] = episode
+            episodeRecord["name"] = "Episode {} {}".format(episode, WORDS[(title["id"] + season * 7 + episode) % len(WORDS)].title())
+            episodeRecord["air_date"] = "{}-{:02d}-01".format(min(title["year"] + season - 1, 2020), min(episode, 12))
+            episodeRecord["overview"] = "Season {} episode {} of {}.".format(season, episode, title["name"])
+            episodeRecord["still_path"] = "/{}.jpg".format(episodeRecord["id"])
+            episodeRecord["vote_average"] = 7.0
+            episodeRecord["vote_count"] = 10
+            episodes.append(episodeRecord)
+        return {"episodes": episodes}
+
+    def search(self, titleType, query, year=None):
+        tokens = set(re.findall(r"\w+", query.casefold()))
+        results = []
+        for title in self.titles[titleType].values():
+            if tokens and tokens <= set(re.findall(r"\w+", title["name"].casefold())):
+                if not year or abs(title["year"] - int(year)) <= 1:
+                    results.append(self.get_summary(titleType=titleType, title=title))
+        results.sort(key=lambda result: -result["popularity"])
+        return {"page": 1, "total_results": len(results), "results": results[:20]}
+
+    def get_response(self, endPoint, params):
+        # Return the status and body TMDB would return for the request
+        parts = endPoint.split("/")
+        if endPoint == "configuration":
+            return 200, {"images": {"base_url": "https://image.tmdb.org/t/p/"}}
+        if endPoint == "configuration/countries":
+            return 200, [{"iso_3166_1": code, "english_name": name} for code, name in COUNTRIES.items()]
+        if endPoint == "configuration/languages":
+            return 200, [{"iso_639_1": code, "english_name": name} for code, name in LANGUAGES.items()]
+        if parts[0] == "genre":
+            return 200, {"genres": [{"id": genreId, "name": name} for genreId, name in GENRES.items()]}
+        if parts[0] == "search" and parts[1] == "person":
+            query = params.get("query", "").casefold()
+            results = [person for person in self.people.values() if person["name"].casefold() == query]
+            return 200, {"page": 1, "total_results": len(results), "results": results}
+        if parts[0] == "search":
+            return 200, self.search(titleType=parts[1], query=params.get("query", ""), year=params.get("year"))
+        if parts[0] == "discover":
+            page = int(params.get("page", 1))
+            titles = sorted(self.titles[parts[1]].values(), key=lambda title: -title["popularity"])[(page - 1) * 20:page * 20]
+            return 200, {"page": page, "results": [self.get_summary(titleType=parts[1], title=title) for title in titles]}
+        if parts[0] == "person" and len(parts) == 3:
+            titleType = parts[2].split("_")[0]
+            personId = int(parts[1])
+            if personId not in self.people:
+                return 404, {"status_message": "The resource you requested could not be found."}
+            cast = [self.get_summary(titleType=titleType, title=self.titles[titleType][titleId]) for titleId in self.credits[titleType][personId]]
+            return 200, {"cast": cast, "crew": []}
+        if parts[0] in self.titles and len(parts) >= 2:
+            title = self.titles[parts[0]].get(int(parts[1]))
+            if not title:
+                return 404, {"status_message": "The resource you requested could not be found."}
+            if len(parts) == 2:
+                return 200, self.get_details(titleType=parts[0], title=title)
+            if parts[2] == "images":
+                return 200, self.get_images(title=title)
+            if parts[2] == "season" and int(parts[3]) <= title.get("seasons", 0):
+                return 200, self.get_season(title=title, season=int(parts[3]))
+        return 404, {"status_message": "The resource you requested could not be found."}
+
+class ReplayAdapter(BaseAdapter):
+    def __init__(self, fixturesDir=None, catalogue=None, record=False):
+        super().__init__()
+        self.fixturesDir = fixturesDir
+        self.catalogue = catalogue
+        self.record = record
+        self.httpAdapter = HTTPAdapter() if record else None
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+
+    def get_fixture_file(self, endPoint, params):
+        # API key is not part of the fixture, so fixtures recorded with any key can be shared
+        key = json.dumps([endPoint, sorted((name, value) for name, value in params if name != "api_key")])
+        return os.path.join(self.fixturesDir, "{}.json".format(hashlib.sha1(key.encode("utf-8")).hexdigest()))
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        endPoint = url.path.split("/3/", 1)[1]
+        params = parse_qsl(url.query)
+        with self.lock:
+            self.calls[re.sub(r"/[0-9]+", "/{id}", endPoint)] += 1
+
+        fixtureFile = self.get_fixture_file(endPoint=endPoint, params=params) if self.fixturesDir else None
+        if self.record:
+            response = self.httpAdapter.send(request, **kwargs)
+            if fixtureFile and response.status_code < 500:
+                os.makedirs(self.fixturesDir, exist_ok=True)
+                with open(fixtureFile, "w") as fixtureFileObj:
+                    json.dump({"endpoint": endPoint, "status": response.status_code, "body": response.json()}, fixtureFileObj)
+            return response
+
+        if fixtureFile and os.path.exists(fixtureFile):
+            with open(fixtureFile, "r") as fixtureFileObj:
+                fixture = json.load(fixtureFileObj)
+            statusCode, body = fixture["status"], fixture["body"]
+        elif self.catalogue:
+            statusCode, body = self.catalogue.get_response(endPoint=endPoint, params=dict(params))
+        else:
+            statusCode, body = 404, {"status_message": "No fixture recorded for {}".format(endPoint)}
+
+        response = requests.Response()
+        response.status_code = statusCode
+        response._content = json.dumps(body).encode("utf-8")
+        response.headers["Content-Type"] = "application/json;charset=utf-8"
+        response.url = request.url
+        response.request = request
+        response.encoding = "utf-8"
+        return response
+
+    def close(self):
+        if self.httpAdapter:
+            self.httpAdapter.close()
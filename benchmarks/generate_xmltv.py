@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import itertools
+import logging
+import os
+import random
+from lxml import etree
+from fake_tmdb import SyntheticCatalogue
+
+# Synthetic XMLTV files for the benchmarks. Programmes are movies and TV episodes from the synthetic TMDB catalogue,
+# titles which can not be found, and news and sport programmes which are not searched. Titles are picked with a Zipf
+# distribution, so that like in real guides a few programmes are aired many times
+
+SIZES = {"1k": 1000, "10k": 10000, "100k": 100000}
+CHANNELS = 20
+
+def get_timestamp(dateTime):
+    return dateTime.strftime("%Y%m%d%H%M%S +0000")
+
+def add_text(element, tag, text, lang="en"):
+    subElement = etree.SubElement(element, tag)
+    subElement.text = str(text)
+    if lang:
+        subElement.set("lang", lang)
+    return subElement
+
+def get_zipf_weights(count):
+    return list(itertools.accumulate(1 / rank for rank in range(1, count + 1)))
+
+class generator(object):
+    def __init__(self, catalogue, seed=0):
+        self.catalogue = catalogue
+        self.rand = random.Random(seed)
+        self.movies = list(catalogue.titles["movie"].values())
+        self.tvshows = list(catalogue.titles["tv"].values())
+        self.rand.shuffle(self.movies)
+        self.rand.shuffle(self.tvshows)
+        self.movieWeights = get_zipf_weights(count=len(self.movies))
+        self.tvshowWeights = get_zipf_weights(count=len(self.tvshows))
+        self.unknownTitles = ["Unknown Programme {}".format(index) for index in range(500)]
+        self.unknownWeights = get_zipf_weights(count=len(self.unknownTitles))
+
+    def get_person(self, personId):
+        return self.catalogue.people[personId]["name"]
+
+    def add_movie(self, element):
+        movie = self.rand.choices(self.movies, cum_weights=self.movieWeights)[0]
+        # Some airings use the original title or a slightly different spelling
+        title = movie["name"] if self.rand.random() < 0.8 else movie["original_name"]
+        if self.rand.random() < 0.1:
+            title = title.upper()
+        add_text(element=element, tag="title", text=title)
+        add_text(element=element, tag="desc", text="Film.")
+        credits = etree.SubElement(element, "credits")
+        add_text(element=credits, tag="director", text=self.get_person(personId=movie["director"]), lang=None)
+        for personId in movie["cast"][:self.rand.randint(0, 4)]:
+            add_text(element=credits, tag="actor", text=self.get_person(personId=personId), lang=None)
+        add_text(element=element, tag="date", text=movie["year"], lang=None)
+        add_text(element=element, tag="category", text="Movie")
+        return 7200
+
+    def add_episode(self, element):
+        tvshow = self.rand.choices(self.tvshows, cum_weights=self.tvshowWeights)[0]
+        season = self.rand.randint(1, tvshow["seasons"])
+        episode = self.rand.randint(1, tvshow["episodes"])
+        add_text(element=element, tag="title", text=tvshow["name"])
+        if self.rand.random() < 0.5:
+            episodes = self.catalogue.get_season(title=tvshow, season=season)["episodes"]
+            add_text(element=element, tag="sub-title", text=episodes[episode - 1]["name"])
+        add_text(element=element, tag="desc", text="Episode.")
+        add_text(element=element, tag="category", text="Series")
+        if self.rand.random() < 0.7:
+            add_text(element=element, tag="episode-num", text="S{:02d}E{:02d}".format(season, episode), lang=None).set("system", "onscreen")
+        return 1800
+
+    def add_unknown(self, element):
+        add_text(element=element, tag="title", text=self.rand.choices(self.unknownTitles, cum_weights=self.unknownWeights)[0])
+        add_text(element=element, tag="desc", text="Not listed on TMDB.")
+        add_text(element=element, tag="category", text=self.rand.choice(["Movie", "Series"]))
+        return 3600
+
+    def add_ignored(self, element):
+        category = self.rand.choice(["News", "Sport"])
+        add_text(element=element, tag="title", text="{} {}".format(category, self.rand.randint(1, 20)))
+        add_text(element=element, tag="category", text=category)
+        return 1800
+
+    def write_file(self, filename, programmes):
+        programmeTypes = [self.add_movie, self.add_episode, self.add_unknown, self.add_ignored]
+        startTimes = [datetime.datetime(2020, 1, 1)] * CHANNELS
+        with etree.xmlfile(filename, encoding="utf-8") as xmlFileObj:
+            xmlFileObj.write_declaration()
+            with xmlFileObj.element("tv"):
+                for channel in range(CHANNELS):
+                    channelElement = etree.Element("channel", id="channel{}.bench".format(channel))
+                    add_text(element=channelElement, tag="display-name", text="Channel {}".format(channel))
+                    xmlFileObj.write(channelElement)
+                for index in range(programmes):
+                    channel = index % CHANNELS
+                    element = etree.Element("programme", channel="channel{}.bench".format(channel))
+                    duration = self.rand.choices(programmeTypes, weights=[30, 45, 10, 15])[0](element=element)
+                    stop = startTimes[channel] + datetime.timedelta(seconds=duration)
+                    element.set("start", get_timestamp(dateTime=startTimes[channel]))
+                    element.set("stop", get_timestamp(dateTime=stop))
+                    startTimes[channel] = stop
+                    xmlFileObj.write(element)
+
+def get_filename(dataDir, size):
+    return os.path.join(dataDir, "programmes_{}.xml".format(size))
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser._action_groups.pop()
+    optional = argParser.add_argument_group('optional arguments')
+    optional.add_argument("-o", "--output-dir", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"), help="Directory the XMLTV files are written to (Default: benchmarks/data)")
+    optional.add_argument("-s", "--size", type=str, action="append", choices=list(SIZES), help="Size of the file to generate, can be repeated (Default: all)")
+    optional.add_argument("--seed", type=int, default=0, help="Random seed, the same seed has to be used by the benchmark (Default: 0)")
+    args = argParser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    catalogue = SyntheticCatalogue(seed=args.seed)
+    for size in args.size or list(SIZES):
+        filename = get_filename(dataDir=args.output_dir, size=size)
+        generator(catalogue=catalogue, seed=args.seed).write_file(filename=filename, programmes=SIZES[size])
+        logging.info("Written {} programmes to {}".format(SIZES[size], filename))
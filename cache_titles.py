@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import collections
+import json
 import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from elastictmdb.movie import Movie
 from elastictmdb.tvshow import Tvshow
 
@@ -10,6 +17,9 @@ optional = argParser.add_argument_group('optional arguments')
 optional.add_argument("-m", "--movie", action="store_true", help="Cache Only Movie Titles")
 optional.add_argument("-t", "--tvshow", action="store_true", help="Cache Only TV Titles")
 optional.add_argument("-l", "--limit", type=int, nargs='?', default=1000, help="Limit cache number (Default: 1000)")
+optional.add_argument("-w", "--workers", type=int, default=8, help="Number of titles cached concurrently (Default: 8)")
+optional.add_argument("-p", "--prefetch", type=int, default=2, help="Number of discover pages fetched ahead (Default: 2)")
+optional.add_argument("-c", "--checkpoint", type=str, help="Checkpoint file, an interrupted run is resumed from it")
 optional.add_argument("-d", "--debug", action="store_true", help="Enable debug output")
 args = argParser.parse_args()
 
@@ -18,6 +28,94 @@ if args.debug:
 else:
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
 
+def load_checkpoint(filename):
+    if filename and os.path.exists(filename):
+        with open(filename, "r") as checkpointFile:
+            return json.load(checkpointFile)
+    return {}
+
+def save_checkpoint(filename, checkpoint):
+    # Replace the file in one step so that an interruption does not leave it truncated
+    if filename:
+        with open("{}.tmp".format(filename), "w") as checkpointFile:
+            json.dump(checkpoint, checkpointFile, indent=2)
+        os.replace("{}.tmp".format(filename), filename)
+
+def prefetch_pages(titleObj, startPage, pages):
+    # Get discover pages ahead of the titles being cached. None is queued once there are no more pages
+    page = startPage
+    try:
+        while True:
+            logging.info("Getting page {} ({})".format(page, titleObj.config["title_type"]))
+            titles = titleObj.discover_title(page=page)
+            if not titles:
+                break
+            pages.put((page, titles))
+            page += 1
+    finally:
+        pages.put(None)
+
+def cache_titles(titleObj, limit, workers, prefetch, checkpointFile, checkpoint):
+    titleType = titleObj.config["title_type"]
+    # Last page fully cached, last title cached of the following page and number of titles cached so far
+    progress = checkpoint.setdefault(titleType, {"page": 0, "title_id": None, "cached": 0})
+    if progress["cached"]:
+        logging.info("Resuming from page {} ({} titles cached) ({})".format(progress["page"] + 1, progress["cached"], titleType))
+
+    pages = queue.Queue(maxsize=prefetch)
+    prefetchThread = threading.Thread(target=prefetch_pages, args=(titleObj, progress["page"] + 1, pages), daemon=True)
+    prefetchThread.start()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    # Titles in flight, in the same order as discovered so that progress only covers titles which are all cached
+    pending = collections.deque()
+    titlesCached = 0
+    startTime = time.time()
+
+    def complete_title():
+        nonlocal titlesCached
+        page, titleId, lastOfPage, future = pending.popleft()
+        future.result()
+        titlesCached += 1
+        progress["cached"] += 1
+        if lastOfPage:
+            progress["page"] = page
+            progress["title_id"] = None
+            save_checkpoint(filename=checkpointFile, checkpoint=checkpoint)
+            logging.info("Found and cached {} title {} ({:.1f} titles/sec)".format(progress["cached"], titleType, titlesCached / (time.time() - startTime)))
+        else:
+            progress["title_id"] = titleId
+
+    try:
+        submitted = progress["cached"]
+        while submitted < limit:
+            item = pages.get()
+            if item is None:
+                break
+            page, titles = item
+            # Skip titles cached before the run was interrupted
+            if progress["title_id"] and page == progress["page"] + 1:
+                titleIds = [title["id"] for title in titles]
+                if progress["title_id"] in titleIds:
+                    titles = titles[titleIds.index(progress["title_id"]) + 1:]
+
+            lastIndex = len(titles) - 1
+            for index, title in enumerate(titles[:limit - submitted]):
+                future = executor.submit(titleObj.cache_title, title=title, force=False, record=None)
+                pending.append((page, title["id"], index == lastIndex, future))
+                submitted += 1
+                if len(pending) >= workers * 4:
+                    complete_title()
+
+        while pending:
+            complete_title()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        save_checkpoint(filename=checkpointFile, checkpoint=checkpoint)
+
+    elapsed = time.time() - startTime
+    logging.info("Done caching titles {} ({}) - {:.1f} titles/sec".format(progress["cached"], titleType, titlesCached / elapsed if elapsed else 0))
+
 titleObjs = []
 if args.movie:
     titleObjs.append(Movie())
@@ -27,20 +125,9 @@ if not args.movie and not args.tvshow:
     titleObjs.append(Movie())
     titleObjs.append(Tvshow())
 
+checkpoint = load_checkpoint(filename=args.checkpoint)
 for titleObj in titleObjs:
-    page = 1
-    titlesCached = 0
-
-    while True:
-        logging.info("Getting page {} ({})".format(page, titleObj.config["title_type"]))
-        titles = titleObj.discover_title(page=page)
-        for title in titles:
-            titleObj.cache_title(title=title, force=False, record={})
-            titlesCached += 1
-            if titlesCached >= args.limit:
-                break
-        if titlesCached >= args.limit:
-            break
-        page += 1
-        logging.info("Found and cached {} title {}".format(titlesCached, titleObj.config["title_type"]))
-    logging.info("Done caching titles {} ({})".format(titlesCached, titleObj.config["title_type"]))
+    cache_titles(titleObj=titleObj, limit=args.limit, workers=args.workers, prefetch=args.prefetch, checkpointFile=args.checkpoint, checkpoint=checkpoint)
+    titleObj.flush()
+    titleObj.tmdb.log_stats()
+    titleObj.bulkWriter.log_stats()
@@ -1,13 +1,34 @@
+import atexit
+import copy
 import logging
 import requests
 import elasticsearch
 import datetime
+import hashlib
+import json
 import os
 import re
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from .config import set_defaults
-from jinja2 import Template
+from .tmdb import TMDB
+from .bulk import BulkWriter
+from .negativecache import NegativeCache
+from .ratelimit import RateLimiter
+from .lrucache import LRUCache
+from .metrics import registry, timed
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 class ElasticTMDB(object):
+    # Concurrency limits per backend, shared by all instances
+    semaphores = {}
+    semaphoresLock = threading.Lock()
+    # TMDB rate limiter, shared by all instances
+    rateLimiter = None
+    # Jinja2 environment, shared by all instances so that templates are compiled once
+    environment = None
+
     def load_config(self):
         set_defaults(self)
 
@@ -15,6 +36,7 @@ class ElasticTMDB(object):
         self.headers = {}
         self.headers["content-type"] = "application/json;charset=utf-8"
         self.headers["Accept-Encoding"] = "gzip"
+        self.tmdb = TMDB(config=self.config, headers=self.headers, semaphore=self.get_semaphore(backend="tmdb"), rateLimiter=self.get_rate_limiter())
 
         if not self.config["extra_logging"]:
             logging.getLogger("elasticsearch").setLevel(logging.WARNING)
@@ -27,6 +49,14 @@ class ElasticTMDB(object):
                                                 port=self.config["es_port"],
                                                 scheme=self.config["es_scheme"],
                                                 http_auth=elasticAuth)
+        self.esSemaphore = self.get_semaphore(backend="es")
+        # Indices with writes not yet visible to searches, and a lock per index so that searches wait for a refresh
+        # started by another thread to finish
+        self.dirtyIndices = set()
+        self.refreshLocks = {}
+        # Records are buffered and written in bulk. Pending records are flushed before searching the index
+        self.bulkWriter = BulkWriter(es=self.es, config=self.config, semaphore=self.esSemaphore, dirtyIndices=self.dirtyIndices)
+        atexit.register(self.flush)
 
         # Generate Index names and create them if they do not exists
         self.config["title_index"] = "{}_{}_title".format(self.config["index_prefix"], self.config["title_type"])
@@ -34,16 +64,55 @@ class ElasticTMDB(object):
         self.check_index(indexName=self.config["title_index"], indexMappingFile="title.json")
         self.check_index(indexName=self.config["search_index"], indexMappingFile="search.json")
 
-        # Get countries, generes, background base URL and languages from TMDB
-        if self.config["initial_cache_tmdb"]:
-            self.cache_configuration()
-        else:
-            logging.debug("Skipping Initial TMDB config...some functions might break")
+        # Responses of title queries (and episodes) recently read from elasticsearch, invalidated when records are written
+        self.recordCache = LRUCache(maxSize=self.config["record_cache_size"], name=self.config["title_type"])
+
+        # Searches which did not find a title
+        self.negativeCache = None
+        if self.config["negative_cache_file"]:
+            self.negativeCache = NegativeCache(filename=self.config["negative_cache_file"], config=self.config)
+
+        # Credits of people searched are fetched and cached concurrently
+        self.creditsExecutor = ThreadPoolExecutor(max_workers=self.config["person_credits_workers"])
+
+        # Countries, generes, background base URL and languages from TMDB are loaded on first use
+        self.tmdbConfiguration = None
+        self.configurationLock = threading.Lock()
+
+    def get_semaphore(self, backend):
+        with ElasticTMDB.semaphoresLock:
+            if backend not in ElasticTMDB.semaphores:
+                ElasticTMDB.semaphores[backend] = threading.BoundedSemaphore(self.config["{}_concurrency".format(backend)])
+            return ElasticTMDB.semaphores[backend]
+
+    def get_rate_limiter(self):
+        if not self.config["tmdb_rate_limit"]:
+            return None
+        with ElasticTMDB.semaphoresLock:
+            if not ElasticTMDB.rateLimiter:
+                ElasticTMDB.rateLimiter = RateLimiter(rate=self.config["tmdb_rate_limit"], burst=self.config["tmdb_rate_burst"], filename=self.config["tmdb_rate_limit_file"])
+            return ElasticTMDB.rateLimiter
+
+    def get_environment(self):
+        with ElasticTMDB.semaphoresLock:
+            if not ElasticTMDB.environment:
+                # Templates in user directories take precedence over the ones included
+                templateDirs = list(self.config["template_dirs"]) + [os.path.join(os.path.dirname(__file__), "templates")]
+                # Compiled templates are saved so that they are not compiled again on the next run
+                bytecodeCache = None
+                try:
+                    bytecodeDir = os.path.join(self.config["cache_dir"], "templates")
+                    os.makedirs(bytecodeDir, exist_ok=True)
+                    bytecodeCache = FileSystemBytecodeCache(directory=bytecodeDir)
+                except OSError as e:
+                    logging.warning("Unable to cache compiled templates in {} - {}".format(bytecodeDir, e))
+                ElasticTMDB.environment = Environment(loader=FileSystemLoader(templateDirs), bytecode_cache=bytecodeCache)
+            return ElasticTMDB.environment
 
     def load_template(self, templateFile):
-        with open(os.path.join(os.path.dirname(__file__), "templates", templateFile), "r") as templateFile:
-            return Template(templateFile.read())
+        return self.get_environment().get_template(templateFile)
 
+    @timed("send_request_get")
     def send_request_get(self, endPoint=None, params=None):
         if not params:
             params = {}
@@ -54,17 +123,21 @@ class ElasticTMDB(object):
         params["api_key"] = self.config["tmdb_api_key"]
 
         if endPoint:
-            response = requests.get("https://api.themoviedb.org/3/{}".format(endPoint), params=params, headers=self.headers)
-            if response:
-                if response.status_code < 400:
-                    return response.json()
-                else:
-                    logging.error("Error Code {} - Message {}".format(response.status_code, response.json()["status_message"]))
-                    del params["api_key"]
-                    logging.error("Error Endpoint {} - Params {}".format(endPoint, params))
-                    return None
+            try:
+                statusCode, response = self.tmdb.get(endPoint=endPoint, params=params)
+            except requests.exceptions.RequestException as e:
+                registry.add_error(name="send_request_get")
+                del params["api_key"]
+                logging.error("Error {} - Endpoint {} - Params {}".format(e, endPoint, params))
+                return None
+            if statusCode < 400:
+                return response
             else:
-                logging.error("Error Code {} - Message {}".format(response.status_code, response.json()["status_message"]))
+                registry.add_error(name="send_request_get")
+                if isinstance(response, dict):
+                    logging.error("Error Code {} - Message {}".format(statusCode, response.get("status_message")))
+                else:
+                    logging.error("Error Code {}".format(statusCode))
                 del params["api_key"]
                 logging.error("Error Endpoint {} - Params {}".format(endPoint, params))
                 return None
@@ -77,42 +150,60 @@ class ElasticTMDB(object):
         if discover:
             return discover["results"]
 
-    def cache_title(self, title, force, record):
-        recordId = None
-        # Check if record exists in elasticsearch
-        if not record:
-            query = {"query": {"term": {"ids.tmdb": title["id"]}}}
-            esRecord = self.get_record_by_query(index=self.config["title_index"], query=query)
-            if esRecord["hits"]["hits"]:
-                recordId = esRecord["hits"]["hits"][0]["_id"]
-                record = esRecord["hits"]["hits"][0]["_source"]
+    @timed("cache_title")
+    def cache_title(self, title, force, record=None):
+        # Returns the record of the title, or None if a TMDB request failed and the title was not cached
+        recordId = self.get_title_id(tmdbId=title["id"])
+        # Check if record exists in elasticsearch, unless already read by the caller (an empty record if it was not
+        # found)
+        if record is None:
+            esRecord = self.get_record_by_id(index=self.config["title_index"], recordId=recordId)
+            if esRecord:
+                record = esRecord["_source"]
         else:
-            recordId = record["_id"]
-            esRecord = {"hits": {"hits": [record]}}
-            record = record["_source"]
+            record = record.get("_source", {})
 
-        if record:
+        titleExists = bool(record)
+        if not record:
+            record = {}
+        else:
             # Check if record is up for an update
             if self.check_update_required(timestamp=record["@timestamp"]):
                 force = True
 
-        if not recordId or force:
+        if not titleExists or force:
             # Get details of title
             params = {}
             if title["original_language"] == self.config["exception_language"]:
                 params["language"] = self.config["exception_language"]
             else:
                 params["language"] = self.config["main_language"]
+            # Fetch credits, translations, alternative titles and images together with the details
+            if self.config["tmdb_append_to_response"]:
+                params["append_to_response"] = "credits,translations,alternative_titles,images"
+                params["include_image_language"] = params["language"]
             title = self.send_request_get(endPoint="{}/{}".format(self.config["title_type"], title["id"]), params=params)
 
             if title:
+                # Resources not appended to the details are requested separately. The title is not indexed if one of
+                # the requests fails, so that it is requested again on the next run instead of being kept incomplete
+                cast = self.get_title_resource(title=title, resource="credits")
+                translations = self.get_title_resource(title=title, resource="translations")
+                altTitles = self.get_title_resource(title=title, resource="alternative_titles")
+                images = None
+                if "image" not in record:
+                    images = self.get_title_images(title=title)
+                if cast is None or translations is None or altTitles is None or ("image" not in record and images is None):
+                    logging.warning("Unable to get details of {} ({}), not cached".format(title["id"], self.config["title_type"]))
+                    return None
+
                 # Get title year, to be used for display
                 if not title.get(self.attrib["date"]):
                     titleYear = "None"
                 else:
                     titleYear = title[self.attrib["date"]][:4]
 
-                if recordId:
+                if titleExists:
                     logging.info("Updating details : {} ({}) ({})".format(title.get(self.attrib["title"], "N/A"), titleYear, self.config["title_type"]))
                 else:
                     logging.info("Getting details : {} ({}) ({})".format(title.get(self.attrib["title"], "N/A"), titleYear, self.config["title_type"]))
@@ -147,9 +238,10 @@ class ElasticTMDB(object):
                 # Add original title to aliases if different
                 if "alias" not in record:
                     record["alias"] = []
+                # Casefolded aliases and title, to check for duplicates without scanning the list
+                aliasSeen = self.get_seen(values=record["alias"] + [record["title"]])
                 if title[self.attrib["title"]] != title[self.attrib["original_title"]]:
-                    if self.check_for_dup(title[self.attrib["original_title"]], record["alias"], record["title"]):
-                        record["alias"].append(title[self.attrib["original_title"]])
+                    self.add_unique(values=record["alias"], value=title[self.attrib["original_title"]], seen=aliasSeen)
 
                 # Release year
                 if "year" not in record:
@@ -168,28 +260,27 @@ class ElasticTMDB(object):
                 # Get cast, director and other crew
                 if "credits" not in record:
                     record["credits"] = {}
-                cast = self.send_request_get(endPoint="{}/{}/credits".format(self.config["title_type"], title["id"]))
+                creditsSeen = {}
+                for creditType in ["actor", "director", "other"]:
+                    creditsSeen[creditType] = self.get_seen(values=record["credits"].get(creditType, []))
                 # Save top 10 cast
                 for person in sorted(cast["cast"], key=lambda k: (k["order"])):
                     if "actor" not in record["credits"]:
                         record["credits"]["actor"] = []
                     if len(record["credits"]["actor"]) < 10:
-                        if self.check_for_dup(person["name"], record["credits"]["actor"]):
-                            record["credits"]["actor"].append(person["name"])
+                        self.add_unique(values=record["credits"]["actor"], value=person["name"], seen=creditsSeen["actor"])
 
                 # Save director and 5 other members of crew (producers etc)
                 for person in cast["crew"]:
                     if person["job"] == 'Director':
                         if "director" not in record["credits"]:
                             record["credits"]["director"] = []
-                        if self.check_for_dup(person["name"], record["credits"]["director"]):
-                            record["credits"]["director"].append(person["name"])
+                        self.add_unique(values=record["credits"]["director"], value=person["name"], seen=creditsSeen["director"])
                     else:
                         if "other" not in record["credits"]:
                             record["credits"]["other"] = []
                         if len(record["credits"]["other"]) < 5:
-                            if self.check_for_dup(person["name"], record["credits"]["other"]):
-                                record["credits"]["other"].append(person["name"])
+                            self.add_unique(values=record["credits"]["other"], value=person["name"], seen=creditsSeen["other"])
 
                 # Get description (and only keep first paragraph) save it only if longer then record if present
                 if "overview" in title:
@@ -213,32 +304,19 @@ class ElasticTMDB(object):
                         record["tagline"] = title["tagline"]
 
                 # Get translations
-                translations = self.send_request_get(endPoint="{}/{}/translations".format(self.config["title_type"], title["id"]))
                 for translation in translations["translations"]:
                     if translation["iso_639_1"] in self.config["languages"]:
                         # Add Aliases
-                        if self.check_for_dup(translation["data"][self.attrib["title"]], record["alias"], record["title"]):
-                            record["alias"].append(translation["data"][self.attrib["title"]])
+                        self.add_unique(values=record["alias"], value=translation["data"][self.attrib["title"]], seen=aliasSeen)
 
                 # Get alternative titles
-                altTitles = self.send_request_get(endPoint="{}/{}/alternative_titles".format(self.config["title_type"], title["id"]))
                 for titleName in altTitles[self.attrib["alt_titles"]]:
                     if titleName["iso_3166_1"] in self.config["countries"]:
-                        if self.check_for_dup(titleName["title"], record["alias"], record["title"]):
-                            record["alias"].append(titleName["title"])
+                        self.add_unique(values=record["alias"], value=titleName["title"], seen=aliasSeen)
 
                 # Get images not not is avaliable
                 if "image" not in record:
                     record["image"] = ""
-                    if title["original_language"] == self.config["exception_language"]:
-                        params = {"language": title["original_language"]}
-                    else:
-                        params = {"language": self.config["main_language"]}
-
-                    images = self.send_request_get(endPoint="{}/{}/images".format(self.config["title_type"], title["id"]), params=params)
-                    if not images["posters"] and not images["backdrops"]:
-                        # Try to search without any language for art
-                        images = self.send_request_get(endPoint="{}/{}/images".format(self.config["title_type"], title["id"]), params={"language": ""})
                     imageAspectRatio = 10
                     for image in images["posters"] + images["backdrops"]:
                         if abs(image["aspect_ratio"] - self.config["image_aspect_ratio"]) < abs(imageAspectRatio - self.config["image_aspect_ratio"]):
@@ -252,22 +330,176 @@ class ElasticTMDB(object):
                         record["ids"]["tmdb"] = title["id"]
 
                 self.index_record(index=self.config["title_index"], recordId=recordId, record=record)
+                # Searches which failed before can find the title now
+                if self.negativeCache:
+                    self.negativeCache.remove_titles(titles=[record["title"]] + record["alias"])
+            else:
+                return None
         else:
-            logging.debug("No update required for {} ({}) ({})".format(esRecord["hits"]["hits"][0]["_source"]["title"], esRecord["hits"]["hits"][0]["_source"]["year"], self.config["title_type"]))
+            logging.debug("No update required for {} ({}) ({})".format(record["title"], record["year"], self.config["title_type"]))
 
         return record
 
-    def search_title(self, search):
-        # First query elasticsearch and check if title is returned without any additional caching
-        result = self.query_title(search=search)
+    def get_title_images(self, title):
+        if title["original_language"] == self.config["exception_language"]:
+            params = {"language": title["original_language"]}
+        else:
+            params = {"language": self.config["main_language"]}
+
+        images = self.get_title_resource(title=title, resource="images", params=params)
+        if not images or (not images["posters"] and not images["backdrops"]):
+            # Try to search without any language for art
+            images = self.send_request_get(endPoint="{}/{}/images".format(self.config["title_type"], title["id"]), params={"language": ""})
+        return images
+
+    def get_title_resource(self, title, resource, params=None):
+        # Use the sub-resource appended to the title details if present, else request it separately
+        if resource in title:
+            return title[resource]
+        return self.send_request_get(endPoint="{}/{}/{}".format(self.config["title_type"], title["id"], resource), params=params)
+
+    def search_many(self, searches, executor=None):
+        # Search many titles. The elasticsearch queries of all the searches are sent first in a few multi search
+        # requests, so that only the searches they do not resolve query elasticsearch again or search TMDB. With an
+        # executor the searches are run concurrently and a future of each search is returned instead of its result
+        results = []
+        for search, prefetched in zip(searches, self.query_many(searches=searches)):
+            # Searches which failed before are not searched again
+            if prefetched is None:
+                result = None
+                if executor:
+                    result = Future()
+                    result.set_result(None)
+            elif executor:
+                result = executor.submit(self.search, search=search, prefetched=prefetched)
+            else:
+                result = self.search(search=search, prefetched=prefetched)
+            results.append(result)
+        return results
+
+    def query_many(self, searches):
+        # Send the elasticsearch queries of many searches (first title query, exact matches and adjacent years) in a
+        # few multi search requests. Returns for each search the responses to pass to search, which only queries
+        # elasticsearch again for queries sent after titles were written. Searches which failed before are not
+        # queried and None is returned for them. Queries in the record cache and repeated queries are not sent
+        generation = self.bulkWriter.get_generation(index=self.config["title_index"])
+        cacheGroup = ("query", self.config["title_index"])
+        querySearches = []
+        queries = {}
+        cacheGenerations = {}
+        responses = {}
+        for search in searches:
+            if self.check_negative_cache(search=search):
+                querySearches.append((search, []))
+                continue
+            searchQueries = [(self.get_query_key(query=query), query) for query in self.build_candidate_queries(search=search)]
+            querySearches.append((search, searchQueries))
+            for queryKey, query in searchQueries:
+                if queryKey in queries or queryKey in responses:
+                    continue
+                cacheKey = ("query", self.config["title_index"], queryKey)
+                response = self.recordCache.get(key=cacheKey)
+                if response:
+                    responses[queryKey] = response
+                else:
+                    cacheGenerations[queryKey] = self.recordCache.get_generation(key=cacheKey, group=cacheGroup)
+                    queries[queryKey] = query
+        for queryKey, response in zip(queries, self.get_records_by_queries(index=self.config["title_index"], queries=list(queries.values()))):
+            # Failed queries are left out, search sends them again on their own
+            if response is None:
+                continue
+            self.recordCache.set(key=("query", self.config["title_index"], queryKey), value=response, generation=cacheGenerations[queryKey], group=cacheGroup)
+            responses[queryKey] = response
+
+        # Each search gets its own copy of a response since results are modified when processed
+        results = []
+        used = set()
+        for search, searchQueries in querySearches:
+            if not searchQueries:
+                results.append(None)
+                continue
+            prefetched = {"generation": generation, "responses": {}}
+            for queryKey, query in searchQueries:
+                if queryKey not in responses:
+                    continue
+                prefetched["responses"][queryKey] = copy.deepcopy(responses[queryKey]) if queryKey in used else responses[queryKey]
+                used.add(queryKey)
+            results.append(prefetched)
+        return results
+
+    def build_candidate_queries(self, search):
+        # Queries of the title index search_title can send, in order
+        queries = [self.build_title_query(search=search)]
+        queries.extend(self.build_exact_queries(search=search))
+        if search.get("year"):
+            queries.append(self.build_adjacent_years_query(search=search))
+        return queries
+
+    def get_query_key(self, query):
+        return json.dumps(query, sort_keys=True)
+
+    def query_index(self, index, query, prefetched=None):
+        # Use the response sent by query_many unless records were written to the index since
+        queryKey = self.get_query_key(query=query)
+        if prefetched and prefetched["generation"] == self.bulkWriter.get_generation(index=index):
+            response = prefetched["responses"].get(queryKey)
+            if response is not None:
+                return response
+        # Responses are kept in memory until a record is written to the index, as the same titles are searched for
+        # every episode or airing of a programme
+        cacheKey = ("query", index, queryKey)
+        cacheGroup = ("query", index)
+        response = self.recordCache.get(key=cacheKey)
+        if response:
+            return response
+        generation = self.recordCache.get_generation(key=cacheKey, group=cacheGroup)
+        response = self.get_record_by_query(index=index, query=query)
+        self.recordCache.set(key=cacheKey, value=response, generation=generation, group=cacheGroup)
+        return response
+
+    def check_negative_cache(self, search):
+        # Return True if the same search did not find a title recently
+        if not self.negativeCache or search.get("force"):
+            return False
+        key = self.negativeCache.get_key(search=search)
+        if self.negativeCache.contains(key=key):
+            # Logged once per search, not for every repeat airing
+            if self.negativeCache.first_skip(key=key):
+                logging.info("Skipping search {} ({}), not found by a search in the last {} days (force to search again)".format(search.get("title"), self.config["title_type"], self.config["negative_cache_days"]))
+            return True
+        return False
+
+    @timed("search_title")
+    def search_title(self, search, prefetched=None):
+        # Searches queried by query_many were already looked up in the negative cache
+        if not prefetched and self.check_negative_cache(search=search):
+            return None
+        # Key is generated before searching since the search can modify the year
+        negativeKey = None
+        if self.negativeCache:
+            negativeKey = self.negativeCache.get_key(search=search)
+
+        # First query elasticsearch and check if title is returned without any additional caching. The response sent
+        # by query_many is used even if titles were written since, as if the search had started earlier. The title is
+        # queried again if the response is missing, for example if the search was queried with different text
+        response = None
+        if prefetched:
+            response = prefetched["responses"].get(self.get_query_key(query=self.build_title_query(search=search)))
+        if response is not None:
+            result = self.check_title_result(search=search, result=response)
+        else:
+            result = self.query_title(search=search, prefetched=prefetched)
 
-        # If no title has been returned, search by director and actors
+        # If no title has been returned, search by director and actors. A search is only added to the negative cache
+        # if all the TMDB requests succeeded, otherwise it could find the title next time
+        searchFailed = False
         if not result or search.get("force"):
             crew = search.get("director", []) + search.get("actor", []) + search.get("other", [])
             for person in crew:
-                self.search_person_tmdb(person=person, year=search.get("year"), force=search.get("force"))
+                if not self.search_person_tmdb(person=person, year=search.get("year"), force=search.get("force")):
+                    searchFailed = True
                 # Query again in elasticsearch and if match then break
-                result = self.query_title(search=search)
+                result = self.query_title(search=search, prefetched=prefetched)
                 if result:
                     break
 
@@ -275,46 +507,96 @@ class ElasticTMDB(object):
             if not result or search.get("force"):
                 if "title" in search:
                     for title in search["title"]:
-                        self.search_title_tmdb(title=title, year=search.get("year"), force=search.get("force"))
-                result = self.query_title(search=search)
+                        if not self.search_title_tmdb(title=title, year=search.get("year"), force=search.get("force")):
+                            searchFailed = True
+                result = self.query_title(search=search, prefetched=prefetched)
 
             # Try an exact match if no result yet
             if not result:
                 if "title" in search:
-                    result = self.query_title_exact(search=search)
+                    result = self.query_title_exact(search=search, prefetched=prefetched)
 
             # Try adjacent years if provided year is not a hit.  This is a workaround as the year supplied by some providers is inaccurate
             if not result:
                 if search.get("year"):
-                    for yearDiff in range(0, self.config["year_diff"] + 1):
-                        final = False
-                        if yearDiff == self.config["year_diff"]:
-                            final = True
-                        result = self.query_title(search=search, yearDiff=yearDiff, final=final)
-                        if result:
-                            break
+                    result = self.query_title_adjacent_years(search=search, prefetched=prefetched)
                 else:
-                    result = self.query_title(search=search, final=True)
+                    result = self.query_title(search=search, final=True, prefetched=prefetched)
 
         if result:
             logging.debug("Found {} ({}) in elasticsearch (Score: {:.1f})".format(result["_source"]["title"], self.config["title_type"], result["_score"]))
             result = self.process_result(result=result, force=search.get("force"))
+            # A forced search can find a title which was not found before
+            if negativeKey and search.get("force"):
+                self.negativeCache.remove(key=negativeKey)
             return result
 
-    def query_title_exact(self, search):
-        query = {"from": 0, "size": 1, "query": {}}
-        query["query"]["bool"] = {}
-        query["query"]["bool"]["should"] = []
-
-        if "title" in search:
-            for title in search["title"]:
+        if negativeKey and not searchFailed:
+            self.negativeCache.add(key=negativeKey, titles=search.get("title", []))
+        elif searchFailed:
+            logging.warning("Unable to search {} ({}), TMDB requests failed".format(search.get("title"), self.config["title_type"]))
+
+    def query_title_exact(self, search, prefetched=None):
+        for query in self.build_exact_queries(search=search):
+            result = self.query_index(index=self.config["title_index"], query=query, prefetched=prefetched)
+            if result["hits"]["total"]["value"] > 0:
+                if result["hits"]["hits"][0]["_score"] >= self.config["min_score_exact"]:
+                    return result["hits"]["hits"][0]
+
+    def build_exact_queries(self, search):
+        # Titles are tried in order, each query matching one more title than the previous one
+        queries = []
+        titles = search.get("title", [])
+        for count in range(1, len(titles) + 1):
+            query = {"from": 0, "size": 1, "query": {}}
+            query["query"]["bool"] = {}
+            query["query"]["bool"]["should"] = []
+            for title in titles[:count]:
                 query["query"]["bool"]["should"].append({"multi_match": {"query": title, "fields": ["title.keyword", "alias.keyword"]}})
-                result = self.get_record_by_query(index=self.config["title_index"], query=query)
-                if result["hits"]["total"]["value"] > 0:
-                    if result["hits"]["hits"][0]["_score"] >= self.config["min_score_exact"]:
-                        return result["hits"]["hits"][0]
-
-    def query_title(self, search, final=False, yearDiff=0):
+            queries.append(query)
+        return queries
+
+    def query_title(self, search, final=False, yearDiff=0, prefetched=None):
+        query = self.build_title_query(search=search, yearDiff=yearDiff)
+        result = self.query_index(index=self.config["title_index"], query=query, prefetched=prefetched)
+        return self.check_title_result(search=search, result=result, final=final)
+
+    def query_title_adjacent_years(self, search, prefetched=None):
+        # Get the best hit of every year within year_diff of the given year with a single query
+        query = self.build_adjacent_years_query(search=search)
+        result = self.query_index(index=self.config["title_index"], query=query, prefetched=prefetched)
+
+        bestHits = {}
+        for bucket in result["aggregations"]["years"]["buckets"]:
+            hit = bucket["best"]["hits"]["hits"][0]
+            yearDiff = abs(int(bucket["key"]) - search["year"])
+            if yearDiff not in bestHits or hit["_score"] > bestHits[yearDiff]["_score"]:
+                bestHits[yearDiff] = hit
+
+        # Widen the year range one year at a time and apply the same min scores as querying each year difference
+        bestHit = None
+        for yearDiff in range(0, self.config["year_diff"] + 1):
+            if yearDiff in bestHits and (not bestHit or bestHits[yearDiff]["_score"] > bestHit["_score"]):
+                bestHit = bestHits[yearDiff]
+            final = False
+            if yearDiff == self.config["year_diff"]:
+                final = True
+            hits = {"hits": {"total": {"value": 0}, "hits": []}}
+            if bestHit:
+                hits = {"hits": {"total": {"value": 1}, "hits": [bestHit]}}
+            result = self.check_title_result(search=search, result=hits, final=final)
+            if result:
+                logging.debug("Found {} with year difference of {}".format(result["_source"]["title"], abs(result["_source"]["year"] - search["year"])))
+                return result
+
+    def build_adjacent_years_query(self, search):
+        query = self.build_title_query(search=search, yearDiff=self.config["year_diff"])
+        query["size"] = 0
+        query["aggs"] = {"years": {"terms": {"field": "year", "size": self.config["year_diff"] * 2 + 1}}}
+        query["aggs"]["years"]["aggs"] = {"best": {"top_hits": {"size": 1}}}
+        return query
+
+    def build_title_query(self, search, yearDiff=0):
         query = {"from": 0, "size": 1, "query": {}}
         query["query"]["bool"] = {}
         query["query"]["bool"]["must"] = []
@@ -349,6 +631,9 @@ class ElasticTMDB(object):
             year["bool"]["should"].append({"range": {"year": {"gte": search["year"] - yearDiff, "lte": search["year"] + yearDiff}}})
             query["query"]["bool"]["must"].append(year)
 
+        return query
+
+    def check_title_result(self, search, result, final=False):
         # Calculate min score
         if not final:
             minScore = self.config["min_score_no_search"]
@@ -357,8 +642,6 @@ class ElasticTMDB(object):
             if "actor" in search:
                 minScore += len(search["actor"] * self.config["score_increment_per_actor"])
 
-        result = self.get_record_by_query(index=self.config["title_index"], query=query)
-
         if result["hits"]["total"]["value"] > 0:
             if result["hits"]["hits"][0]["_score"] >= minScore:
                 return result["hits"]["hits"][0]
@@ -371,7 +654,10 @@ class ElasticTMDB(object):
     def process_result(self, result, force):
         # Check if record requires updating
         title = {"id": result["_source"]["ids"]["tmdb"], "original_language": result["_source"]["language"]}
-        result["_source"] = self.cache_title(title=title, force=force, record=result)
+        record = self.cache_title(title=title, force=force, record=result)
+        # Record read from elasticsearch is used if it could not be updated
+        if record is not None:
+            result["_source"] = record
 
         # Generate full image URL if missing
         result["_source"]["image"] = self.get_image_url(image=result["_source"]["image"])
@@ -397,22 +683,18 @@ class ElasticTMDB(object):
         return result
 
     def search_person_tmdb(self, person, year, force):
+        # Returns False if a TMDB request failed
         performSearch = force
-        recordId = None
+        recordId = self.get_search_id(field="person", value=person, year=year)
 
         # Check if search was already performed
-        query = {"query": {"bool": {"must": []}}}
-        query["query"]["bool"]["must"].append({"term": {"person": person}})
-        query["query"]["bool"]["must"].append({"term": {"year": year or -1}})
-
-        result = self.get_record_by_query(index=self.config["search_index"], query=query)
-        if result["hits"]["total"]["value"] == 0:
+        result = self.get_record_by_id(index=self.config["search_index"], recordId=recordId)
+        if not result:
             performSearch = True
         else:
             # Check if person is up for an update:
-            if self.check_update_required(timestamp=result["hits"]["hits"][0]["_source"]["@timestamp"]):
+            if self.check_update_required(timestamp=result["_source"]["@timestamp"]):
                 performSearch = True
-                recordId = result["hits"]["hits"][0]["_id"]
 
         if performSearch:
             # Query TMDB for person
@@ -420,21 +702,33 @@ class ElasticTMDB(object):
             params["query"] = person
             logging.info("Searching for person : {}".format(person))
             response = self.send_request_get("search/person", params=params)
+            # Search is not saved if a request failed, so that it is performed again next time
+            if response is None:
+                return False
             if "total_results" in response:
                 if response["total_results"] > 0:
+                    # Search credits of people found concurrently
                     for personRecord in response["results"]:
-                        # Search credits of person found
                         logging.info("Getting credits : {} ({}) ({})".format(personRecord["name"], year, self.config["title_type"]))
-                        credits = self.send_request_get("person/{}/{}_credits".format(personRecord["id"], self.config["title_type"]))
-                        # Find titles during years around query or if year=-1 all credits
-                        if "crew" in credits:
-                            for credit in credits["crew"] + credits["cast"]:
-                                if "release_date" in credit and year:
-                                    if credit["release_date"] != '' and credit["release_date"]:
-                                        creditYear = int(credit["release_date"][:4])
-                                        if abs(year - creditYear) > self.config["year_diff"]:
-                                            continue
-                                self.cache_title(title=credit, force=force, record={})
+                    endPoints = ["person/{}/{}_credits".format(personRecord["id"], self.config["title_type"]) for personRecord in response["results"]]
+                    # Titles are cached once even if credited to more than one person found
+                    titles = {}
+                    creditsFailed = False
+                    for credits in self.creditsExecutor.map(self.send_request_get, endPoints):
+                        if credits is None:
+                            creditsFailed = True
+                        for credit in self.filter_person_credits(credits=credits, year=year):
+                            titles.setdefault(credit["id"], credit)
+
+                    # Titles already cached are read in a single request
+                    records = self.get_records_by_ids(index=self.config["title_index"], recordIds=[self.get_title_id(tmdbId=titleId) for titleId in titles])
+                    futures = []
+                    for credit in titles.values():
+                        record = records.get(self.get_title_id(tmdbId=credit["id"]), {})
+                        futures.append(self.creditsExecutor.submit(self.cache_title, title=credit, force=force, record=record))
+                    records = [future.result() for future in futures]
+                    if creditsFailed or None in records:
+                        return False
 
             # Save that name and year to avoid doing the same search again
             record = {}
@@ -443,24 +737,39 @@ class ElasticTMDB(object):
             self.index_record(index=self.config["search_index"], record=record, recordId=recordId)
         else:
             logging.debug("Already searched credits for {} ({}) ({})".format(person, year, self.config["title_type"]))
+        return True
+
+    def filter_person_credits(self, credits, year):
+        # Find titles during years around query or if year=-1 all credits. Most popular titles are kept if the
+        # person has more credits than the max
+        titles = {}
+        if credits and "crew" in credits:
+            for credit in credits["crew"] + credits["cast"]:
+                if "release_date" in credit and year:
+                    if credit["release_date"] != '' and credit["release_date"]:
+                        creditYear = int(credit["release_date"][:4])
+                        if abs(year - creditYear) > self.config["year_diff"]:
+                            continue
+                # Person can be credited more than once for the same title
+                titles.setdefault(credit["id"], credit)
+        titles = list(titles.values())
+        if self.config["person_credits_max"]:
+            titles = sorted(titles, key=lambda k: k.get("popularity") or 0, reverse=True)[:self.config["person_credits_max"]]
+        return titles
 
     def search_title_tmdb(self, title, year, force):
+        # Returns False if a TMDB request failed
         performSearch = force
-        recordId = None
+        recordId = self.get_search_id(field="title", value=title, year=year)
 
         # Check if search was already performed
-        query = {"query": {"bool": {"must": []}}}
-        query["query"]["bool"]["must"].append({"term": {"title": title}})
-        query["query"]["bool"]["must"].append({"term": {"year": year or -1}})
-
-        result = self.get_record_by_query(index=self.config["search_index"], query=query)
-        if result["hits"]["total"]["value"] == 0:
+        result = self.get_record_by_id(index=self.config["search_index"], recordId=recordId)
+        if not result:
             performSearch = True
         else:
-            # Check if person is up for an update:
-            if self.check_update_required(timestamp=result["hits"]["hits"][0]["_source"]["@timestamp"]):
+            # Check if title is up for an update:
+            if self.check_update_required(timestamp=result["_source"]["@timestamp"]):
                 performSearch = True
-                recordId = result["hits"]["hits"][0]["_id"]
 
         if performSearch:
             params = {"include_adult": "false", "page": 1}
@@ -469,10 +778,16 @@ class ElasticTMDB(object):
                 params["year"] = year
             logging.info("Searching for title : {} ({}) ({})".format(title, year, self.config["title_type"]))
             response = self.send_request_get(endPoint="search/{}".format(self.config["title_type"]), params=params)
+            # Search is not saved if a request failed, so that it is performed again next time
+            if response is None:
+                return False
             if "total_results" in response:
                 if response["total_results"] > 0:
-                    for result in response["results"][:5]:
-                        self.cache_title(title=result, force=force, record={})
+                    results = response["results"][:5]
+                    records = self.get_records_by_ids(index=self.config["title_index"], recordIds=[self.get_title_id(tmdbId=result["id"]) for result in results])
+                    records = [self.cache_title(title=result, force=force, record=records.get(self.get_title_id(tmdbId=result["id"]), {})) for result in results]
+                    if None in records:
+                        return False
 
             # Save title and year to avoid doing the same search again
             record = {}
@@ -481,33 +796,43 @@ class ElasticTMDB(object):
             self.index_record(index=self.config["search_index"], record=record, recordId=recordId)
         else:
             logging.debug("Already searched title {} ({}) ({})".format(title, year, self.config["title_type"]))
+        return True
 
     def get_image_url(self, image):
         if "http" not in image:
-            return "{}/{}".format(self.config["image_base_url"], image)
+            return "{}/{}".format(self.get_configuration()["image_base_url"], image)
         else:
             return image
 
-    def check_for_dup(self, title, alias, orgTitle=""):
-        if title == "":
-            return False
-        if alias:
-            for altTitle in alias + [orgTitle]:
-                if re.search("^{}$".format(re.escape(title)), altTitle, flags=re.IGNORECASE):
-                    return False
-            else:
-                return True
-        if orgTitle:
-            if re.search("^{}$".format(re.escape(title)), orgTitle, flags=re.IGNORECASE):
-                return False
-        return True
+    def get_seen(self, values):
+        return {value.casefold() for value in values if value}
 
+    def add_unique(self, values, value, seen):
+        # Append value unless it is empty or already in the list ignoring case. Seen holds the casefolded values
+        # of the list and is updated, so the order of the list is kept
+        if not value:
+            return
+        key = value.casefold()
+        if key not in seen:
+            seen.add(key)
+            values.append(value)
+
+    @timed("render_template")
     def render_template(self, record, template):
         if template == "description":
             return self.description_template.render(record=record)
         elif template == "subtitle":
             return self.subtitle_template.render(record=record)
 
+    @timed("render_templates")
+    def render_templates(self, record):
+        # Render description and subtitle with the same context
+        context = {"record": record}
+        rendered = {}
+        rendered["description"] = self.description_template.render(context)
+        rendered["subtitle"] = self.subtitle_template.render(context)
+        return rendered
+
     def check_index(self, indexName, indexMappingFile):
         if not self.es.indices.exists(index=indexName):
             with open(os.path.join(os.path.dirname(__file__), "index_mapping", indexMappingFile), "r") as mappingFile:
@@ -516,14 +841,91 @@ class ElasticTMDB(object):
             if response["acknowledged"]:
                 logging.info("Created {} index".format(indexName))
 
-    def get_record_by_query(self, index, query, refreshIndex=True):
-        if refreshIndex:
-            self.es.indices.refresh(index=index)
-        return self.es.search(index=index, body=query)
+    @timed("get_record_by_query")
+    def get_record_by_query(self, index, query, refreshIndex=False):
+        self.bulkWriter.flush(index=index)
+        self.refresh_index(index=index, force=refreshIndex)
+        with self.esSemaphore:
+            return self.es.search(index=index, body=query)
+
+    def refresh_index(self, index, force=False):
+        # Only refresh if records were written to the index since the last refresh. The flag is cleared and the index
+        # refreshed while holding the lock of the index, so a search never sees the index as clean before the refresh
+        # has finished. Records flushed during the refresh mark the index dirty again
+        with self.refreshLocks.setdefault(index, threading.Lock()):
+            if force or index in self.dirtyIndices:
+                self.dirtyIndices.discard(index)
+                try:
+                    with self.esSemaphore:
+                        self.es.indices.refresh(index=index)
+                except Exception:
+                    self.dirtyIndices.add(index)
+                    raise
+
+    @timed("get_record_by_id")
+    def get_record_by_id(self, index, recordId):
+        # Realtime get, records written are found without refreshing the index once flushed. Pending records are only
+        # flushed if the record read is one of them
+        self.bulkWriter.flush(index=index, recordIds=[recordId])
+        with self.esSemaphore:
+            try:
+                return self.es.get(index=index, id=recordId)
+            except elasticsearch.NotFoundError:
+                return None
 
+    @timed("get_records_by_ids")
+    def get_records_by_ids(self, index, recordIds):
+        # Return records found by ID
+        if not recordIds:
+            return {}
+        self.bulkWriter.flush(index=index, recordIds=recordIds)
+        with self.esSemaphore:
+            response = self.es.mget(index=index, body={"ids": recordIds})
+        return {record["_id"]: record for record in response["docs"] if record.get("found")}
+
+    def get_title_id(self, tmdbId):
+        return "tmdb:{}".format(tmdbId)
+
+    def get_search_id(self, field, value, year):
+        # Searched names can be long and contain any character so a hash is used
+        return "{}:{}".format(field, hashlib.sha1(json.dumps([value, int(year or -1)]).encode("utf-8")).hexdigest())
+
+    @timed("get_records_by_queries")
+    def get_records_by_queries(self, index, queries):
+        self.bulkWriter.flush(index=index)
+        self.refresh_index(index=index)
+
+        # Send queries with multi search in batches
+        results = []
+        for batchStart in range(0, len(queries), self.config["msearch_size"]):
+            body = []
+            for query in queries[batchStart:batchStart + self.config["msearch_size"]]:
+                body.append({"index": index})
+                body.append(query)
+            with self.esSemaphore:
+                response = self.es.msearch(body=body)
+            # None is returned for queries which failed, for example rejected by a busy node
+            for result in response["responses"]:
+                if "error" in result:
+                    registry.add_error(name="get_records_by_queries")
+                    logging.error("Error searching {} - {}".format(index, result["error"]))
+                    result = None
+                results.append(result)
+        return results
+
+    @timed("index_record")
     def index_record(self, index, record, recordId=None):
         record["@timestamp"] = datetime.datetime.utcnow().isoformat()
-        self.es.index(index=index, id=recordId, body=record)
+        self.bulkWriter.index(index=index, record=record, recordId=recordId)
+        # Records kept in memory are no longer current. Invalidated once the record is pending, so that reads started
+        # after the invalidation flush it first
+        if index == self.config["title_index"]:
+            self.recordCache.invalidate(group=("query", index))
+        elif index == self.config.get("episode_index"):
+            self.recordCache.invalidate(group=("episode", record["tvshow_id"]))
+
+    def flush(self):
+        self.bulkWriter.flush()
 
     def check_update_required(self, timestamp):
         timestamp = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f")
@@ -532,29 +934,86 @@ class ElasticTMDB(object):
         else:
             return False
 
+    @property
+    def genres(self):
+        return self.get_configuration()["genres"]
+
+    @property
+    def countries(self):
+        return self.get_configuration()["countries"]
+
+    @property
+    def countryCodes(self):
+        return self.get_configuration()["countryCodes"]
+
+    @property
+    def languages(self):
+        return self.get_configuration()["languages"]
+
+    def get_configuration(self):
+        # Countries, generes, background base URL and languages are loaded on first use
+        if self.tmdbConfiguration is None:
+            with self.configurationLock:
+                if self.tmdbConfiguration is None:
+                    self.tmdbConfiguration = self.load_configuration()
+        return self.tmdbConfiguration
+
+    def load_configuration(self):
+        if not self.config["initial_cache_tmdb"]:
+            logging.debug("Skipping Initial TMDB config...some functions might break")
+            return {"genres": {}, "countries": {}, "countryCodes": {}, "languages": {}, "image_base_url": ""}
+
+        # Use configuration saved by a previous run if not expired
+        cacheFile = os.path.join(self.config["cache_dir"], "configuration_{}.json".format(self.config["title_type"]))
+        try:
+            if time.time() - os.path.getmtime(cacheFile) < self.config["configuration_refresh_days"] * 86400:
+                with open(cacheFile, "r") as configurationFile:
+                    configuration = json.load(configurationFile)
+                # JSON keys are always strings
+                configuration["genres"] = {int(genreId): genre for genreId, genre in configuration["genres"].items()}
+                return configuration
+        except (OSError, ValueError, KeyError):
+            pass
+
+        configuration = self.cache_configuration()
+        # Only save if all lookups were returned by TMDB
+        if all(configuration.values()):
+            try:
+                os.makedirs(self.config["cache_dir"], exist_ok=True)
+                with open(cacheFile + ".tmp", "w") as configurationFile:
+                    json.dump(configuration, configurationFile)
+                os.replace(cacheFile + ".tmp", cacheFile)
+            except OSError as e:
+                logging.warning("Unable to save TMDB configuration to {} - {}".format(cacheFile, e))
+        return configuration
+
     def cache_configuration(self):
-        self.genres = {}
-        self.countries = {}
-        self.countryCodes = {}
-        self.languages = {}
+        configuration = {}
+        configuration["genres"] = {}
+        configuration["countries"] = {}
+        configuration["countryCodes"] = {}
+        configuration["languages"] = {}
+        configuration["image_base_url"] = ""
 
         genres = self.send_request_get(endPoint="genre/{}/list".format(self.config["title_type"]))
         if genres:
             for genre in genres["genres"]:
-                self.genres[genre["id"]] = genre["name"]
+                configuration["genres"][genre["id"]] = genre["name"]
 
         countries = self.send_request_get(endPoint="configuration/countries")
         if countries:
             for country in countries:
-                self.countries[country["iso_3166_1"]] = country["english_name"]
-                self.countryCodes[country["english_name"]] = country["iso_3166_1"]
+                configuration["countries"][country["iso_3166_1"]] = country["english_name"]
+                configuration["countryCodes"][country["english_name"]] = country["iso_3166_1"]
 
         languages = self.send_request_get(endPoint="configuration/languages")
         if languages:
             for language in languages:
-                self.languages[language["iso_639_1"]] = language["english_name"]
+                configuration["languages"][language["iso_639_1"]] = language["english_name"]
 
         backgroundUrl = self.send_request_get(endPoint="configuration")
         if backgroundUrl:
-            self.config["image_base_url"] = backgroundUrl["images"]["base_url"]
-            self.config["image_base_url"] += self.config["tmdb_image_type"]
+            configuration["image_base_url"] = backgroundUrl["images"]["base_url"]
+            configuration["image_base_url"] += self.config["tmdb_image_type"]
+
+        return configuration
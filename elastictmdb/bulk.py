@@ -0,0 +1,85 @@
+import collections
+import copy
+import logging
+import threading
+import time
+from elasticsearch import helpers
+
+class BulkWriter(object):
+    def __init__(self, es, config, semaphore, dirtyIndices):
+        self.es = es
+        self.config = config
+        self.semaphore = semaphore
+        # Indices flushed but not refreshed yet, shared with the searching instance
+        self.dirtyIndices = dirtyIndices
+
+        self.lock = threading.RLock()
+        self.actions = []
+        self.pendingIndices = set()
+        # Index and ID of pending records written with an ID, so that reads by ID only flush when they can see them
+        self.pendingIds = set()
+        self.firstPending = None
+        self.timer = None
+        # Number of records written to each index, so that readers can tell whether an index changed
+        self.generations = collections.Counter()
+
+        self.written = 0
+        self.errors = 0
+
+    def index(self, index, record, recordId=None):
+        action = {"_op_type": "index", "_index": index, "_source": copy.deepcopy(record)}
+        if recordId:
+            action["_id"] = recordId
+
+        with self.lock:
+            self.actions.append(action)
+            self.pendingIndices.add(index)
+            self.generations[index] += 1
+            if recordId:
+                self.pendingIds.add((index, recordId))
+            if not self.firstPending:
+                self.firstPending = time.time()
+                # Flush after the interval even if no more records are added
+                self.timer = threading.Timer(self.config["bulk_flush_interval"], self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+            if len(self.actions) >= self.config["bulk_size"] or time.time() - self.firstPending >= self.config["bulk_flush_interval"]:
+                self.flush()
+
+    def get_generation(self, index):
+        with self.lock:
+            return self.generations[index]
+
+    def flush(self, index=None, recordIds=None):
+        with self.lock:
+            # Only flush if there are pending records for the index about to be searched, or one of the records about
+            # to be read by ID is pending
+            if not self.actions or (index and index not in self.pendingIndices):
+                return
+            if recordIds is not None and not any((index, recordId) in self.pendingIds for recordId in recordIds):
+                return
+
+            actions = self.actions
+            indices = self.pendingIndices
+            self.actions = []
+            self.pendingIndices = set()
+            self.pendingIds = set()
+            self.firstPending = None
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+            with self.semaphore:
+                success, errors = helpers.bulk(self.es, actions, stats_only=False, raise_on_error=False, raise_on_exception=False)
+            self.dirtyIndices.update(indices)
+
+            self.written += success
+            self.errors += len(errors)
+            for error in errors:
+                for opType, item in error.items():
+                    logging.error("Error indexing record in {} (ID: {}) - Status {} - {}".format(item.get("_index"), item.get("_id"), item.get("status"), item.get("error")))
+            logging.debug("Flushed {} records to {}".format(len(actions), ", ".join(sorted(indices))))
+
+    def log_stats(self):
+        logging.info("Elasticsearch records written {} - Errors {}".format(self.written, self.errors))
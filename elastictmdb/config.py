@@ -6,6 +6,42 @@ def set_defaults(self):
     self.config["tmdb_api_key"] = os.environ['TMDB_API_KEY']
     # TMDB poster image size. Other options can be obtained by quering https://developers.themoviedb.org/3/configuration/get-api-configuration
     self.config["tmdb_image_type"] = "w300"
+    # Number of keep-alive connections kept open to TMDB
+    self.config["tmdb_pool_size"] = 10
+    # Connect and read timeouts in seconds for TMDB requests
+    self.config["tmdb_connect_timeout"] = 5
+    self.config["tmdb_read_timeout"] = 30
+    # Retries for failed or rate limited (HTTP 429) TMDB requests, each waiting for the rate limiter. Retry-After header
+    # is honoured when present
+    self.config["tmdb_retries"] = 5
+    self.config["tmdb_backoff_factor"] = 0.5
+    # Get title details, credits, translations, alternative titles and images in a single TMDB request
+    self.config["tmdb_append_to_response"] = True
+    # Cache TMDB responses in an SQLite file (for example os.path.join(self.config["cache_dir"], "tmdb.sqlite")). None to disable
+    self.config["tmdb_cache_file"] = None
+    # Max size in bytes of cached responses. Least recently used responses are removed first
+    self.config["tmdb_cache_max_size"] = 500 * 1024 * 1024
+    # Seconds responses are used without contacting TMDB, first matching endpoint pattern is used. Stale responses are
+    # revalidated with their ETag
+    self.config["tmdb_cache_ttl"] = [
+        (r"^(genre/|configuration)", 7 * 86400),
+        (r"^tv/[0-9]+/season/", 6 * 3600),
+        (r"^(movie|tv|person)/[0-9]+", 86400),
+        (r"^search/", 6 * 3600),
+        (r"^discover/", 3600)
+    ]
+    self.config["tmdb_cache_default_ttl"] = 3600
+
+    # Directory where data fetched from TMDB is saved between runs
+    self.config["cache_dir"] = os.path.join(os.path.expanduser("~"), ".cache", "elastictmdb")
+    # Directories with templates overriding the ones included (for example movie_description.j2), searched in order
+    self.config["template_dirs"] = []
+    # Days after which the saved TMDB genres, countries, languages and image configuration are fetched again
+    self.config["configuration_refresh_days"] = 7
+    # Searches which did not find a title are saved in this SQLite file and not searched again (none of the
+    # elasticsearch queries or TMDB searches are done) until they are older than the given number of days. None to disable
+    self.config["negative_cache_file"] = os.path.join(self.config["cache_dir"], "negative.sqlite")
+    self.config["negative_cache_days"] = 3
 
     # Connection details for Elasticsearch
     self.config["es_host"] = ["127.0.0.1"]
@@ -15,6 +51,35 @@ def set_defaults(self):
     self.config["es_username"] = ""
     self.config["es_password"] = ""
 
+    # Requests per second sent to TMDB, after a burst of tmdb_rate_burst requests. Requests wait for their turn
+    # instead of failing. The limit is shared by processes using the same file (None to only share it within the
+    # process). Set tmdb_rate_limit to None to disable
+    self.config["tmdb_rate_limit"] = 40
+    self.config["tmdb_rate_burst"] = 40
+    self.config["tmdb_rate_limit_file"] = os.path.join(self.config["cache_dir"], "tmdb_ratelimit")
+
+    # Max number of requests in flight to each backend when titles are searched concurrently (shared by all instances)
+    self.config["es_concurrency"] = 8
+    self.config["tmdb_concurrency"] = 8
+
+    # Number of threads caching the credits of people searched, and max number of credits cached for each person
+    # found, most popular first (Default: None, all credits are cached as before)
+    self.config["person_credits_workers"] = 4
+    self.config["person_credits_max"] = None
+
+    # Max number of title query responses and episodes read from elasticsearch kept in memory by each instance. 0 to
+    # disable
+    self.config["record_cache_size"] = 10000
+    # Max number of programme search results kept in memory by process_xmltv, so that repeat airings are not searched
+    # again. Least recently used results are removed first
+    self.config["programme_cache_size"] = 10000
+
+    # Records are written to elasticsearch in batches of this size or after this many seconds
+    self.config["bulk_size"] = 500
+    self.config["bulk_flush_interval"] = 5
+    # Max number of queries sent in a single multi search request
+    self.config["msearch_size"] = 100
+
     # Prefix to use when naming indexes
     self.config["index_prefix"] = "tmdb"
 
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+class ResponseCache(object):
+    def __init__(self, filename, config):
+        self.config = config
+        # Compile TTL patterns once, first matching pattern is used
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in self.config["tmdb_cache_ttl"]]
+
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, endpoint TEXT, etag TEXT, body TEXT, size INTEGER, fetched REAL, accessed REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed)")
+        # Total size of the responses, kept in the file since it can be shared by several processes
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY, size INTEGER)")
+        self.db.execute("INSERT OR IGNORE INTO cache_size (id, size) SELECT 0, COALESCE(SUM(size), 0) FROM response")
+
+    def get_key(self, endPoint, params):
+        # API key is not part of the key so that the cache survives a change of key
+        cacheParams = sorted((name, str(value)) for name, value in params.items() if name != "api_key")
+        return "{}?{}".format(endPoint, json.dumps(cacheParams))
+
+    def get_ttl(self, endPoint):
+        for pattern, ttl in self.ttls:
+            if pattern.search(endPoint):
+                return ttl
+        return self.config["tmdb_cache_default_ttl"]
+
+    def get(self, key, endPoint):
+        with self.lock:
+            row = self.db.execute("SELECT etag, body, fetched FROM response WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            self.db.execute("UPDATE response SET accessed = ? WHERE key = ?", (time.time(), key))
+
+        cached = {}
+        cached["etag"] = row[0]
+        cached["body"] = json.loads(row[1])
+        cached["fresh"] = time.time() - row[2] < self.get_ttl(endPoint=endPoint)
+        return cached
+
+    def set(self, key, endPoint, etag, body):
+        size = len(body)
+        now = time.time()
+        with self.lock:
+            # Other processes wait for the transaction, so that the total size stays consistent
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT size FROM response WHERE key = ?", (key,)).fetchone()
+                self.db.execute("INSERT OR REPLACE INTO response (key, endpoint, etag, body, size, fetched, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (key, endPoint, etag, body, size, now, now))
+                self.db.execute("UPDATE cache_size SET size = size + ? WHERE id = 0", (size - (row[0] if row else 0),))
+                totalSize = self.db.execute("SELECT size FROM cache_size WHERE id = 0").fetchone()[0]
+                if totalSize > self.config["tmdb_cache_max_size"]:
+                    self.evict(totalSize=totalSize)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def touch(self, key):
+        # Response was revalidated, so it is fresh again
+        now = time.time()
+        with self.lock:
+            self.db.execute("UPDATE response SET fetched = ?, accessed = ? WHERE key = ?", (now, now, key))
+
+    def evict(self, totalSize):
+        # Remove least recently used responses until the cache is 10% below its maximum size
+        targetSize = self.config["tmdb_cache_max_size"] * 0.9
+        evicted = 0
+        evictedSize = 0
+        for key, size in self.db.execute("SELECT key, size FROM response ORDER BY accessed").fetchall():
+            if totalSize - evictedSize <= targetSize:
+                break
+            self.db.execute("DELETE FROM response WHERE key = ?", (key,))
+            evictedSize += size
+            evicted += 1
+        self.db.execute("UPDATE cache_size SET size = size - ? WHERE id = 0", (evictedSize,))
+        logging.debug("Evicted {} responses from TMDB cache".format(evicted))
@@ -0,0 +1,70 @@
+import collections
+import copy
+import logging
+import threading
+
+class LRUCache(object):
+    # Records read from elasticsearch kept in memory, least recently used records are removed first. Records are
+    # copied in and out since callers modify the records returned
+    def __init__(self, maxSize, name):
+        self.maxSize = maxSize
+        self.name = name
+        self.lock = threading.Lock()
+        self.records = collections.OrderedDict()
+        # Keys of each group, so that all records of a group (for example episodes of a show) can be invalidated
+        self.groups = {}
+        # Incremented when a key or group is invalidated, records read before an invalidation of their key or group are
+        # not added
+        self.generations = collections.Counter()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.records:
+                self.records.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(self.records[key][0])
+            self.misses += 1
+        return None
+
+    def get_generation(self, key, group=None):
+        with self.lock:
+            return (self.generations[key], self.generations[group])
+
+    def set(self, key, value, generation, group=None):
+        value = copy.deepcopy(value)
+        with self.lock:
+            if generation != (self.generations[key], self.generations[group]):
+                return
+            self.records[key] = (value, group)
+            self.records.move_to_end(key)
+            if group is not None:
+                self.groups.setdefault(group, set()).add(key)
+            while len(self.records) > self.maxSize:
+                self.remove(key=next(iter(self.records)))
+
+    def invalidate(self, key=None, group=None):
+        with self.lock:
+            if key is not None:
+                self.generations[key] += 1
+                if key in self.records:
+                    self.remove(key=key)
+            if group is not None:
+                self.generations[group] += 1
+            for groupKey in list(self.groups.get(group, [])):
+                self.remove(key=groupKey)
+
+    def remove(self, key):
+        value, group = self.records.pop(key)
+        if group is not None:
+            self.groups[group].discard(key)
+            if not self.groups[group]:
+                del self.groups[group]
+
+    def log_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            if lookups:
+                logging.info("In memory {} cache hits {} of {} ({:.1%})".format(self.name, self.hits, lookups, self.hits / lookups))
@@ -0,0 +1,114 @@
+import bisect
+import functools
+import threading
+import time
+
+class Metrics(object):
+    # Upper bounds in seconds of the latency histogram buckets, the last bucket holds slower calls
+    buckets = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+
+    def get_timer(self, name):
+        if name not in self.timers:
+            self.timers[name] = {"count": 0, "errors": 0, "total": 0.0, "max": 0.0, "histogram": [0] * (len(self.buckets) + 1)}
+        return self.timers[name]
+
+    def observe(self, name, duration, error=False):
+        with self.lock:
+            timer = self.get_timer(name=name)
+            timer["count"] += 1
+            timer["total"] += duration
+            timer["max"] = max(timer["max"], duration)
+            timer["histogram"][bisect.bisect_left(self.buckets, duration)] += 1
+            if error:
+                timer["errors"] += 1
+
+    def add_error(self, name):
+        # Error reported without an exception (for example a failed request returning None)
+        with self.lock:
+            self.get_timer(name=name)["errors"] += 1
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timed(self, name):
+        # Decorator recording the duration of calls, calls raising an exception are counted as errors
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                startTime = time.perf_counter()
+                error = True
+                try:
+                    result = function(*args, **kwargs)
+                    error = False
+                    return result
+                finally:
+                    self.observe(name=name, duration=time.perf_counter() - startTime, error=error)
+            return wrapper
+        return decorator
+
+    def collect(self, reset=False):
+        # Copy of the metrics, which can be merged into the metrics of another process
+        with self.lock:
+            snapshot = {"timers": {name: dict(timer, histogram=list(timer["histogram"])) for name, timer in self.timers.items()},
+                        "counters": dict(self.counters)}
+            if reset:
+                self.timers = {}
+                self.counters = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, other in snapshot["timers"].items():
+                timer = self.get_timer(name=name)
+                timer["count"] += other["count"]
+                timer["errors"] += other["errors"]
+                timer["total"] += other["total"]
+                timer["max"] = max(timer["max"], other["max"])
+                timer["histogram"] = [count + otherCount for count, otherCount in zip(timer["histogram"], other["histogram"])]
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_report(self):
+        snapshot = self.collect()
+        report = {"timers": {}, "counters": snapshot["counters"]}
+        for name, timer in sorted(snapshot["timers"].items()):
+            report["timers"][name] = {}
+            report["timers"][name]["count"] = timer["count"]
+            report["timers"][name]["errors"] = timer["errors"]
+            report["timers"][name]["total_s"] = round(timer["total"], 3)
+            report["timers"][name]["avg_ms"] = round(timer["total"] / timer["count"] * 1000, 3) if timer["count"] else 0.0
+            report["timers"][name]["max_ms"] = round(timer["max"] * 1000, 3)
+            # Cumulative counts, as in Prometheus histograms
+            report["timers"][name]["histogram"] = {}
+            cumulative = 0
+            for bucket, count in zip([str(bucket) for bucket in self.buckets] + ["+Inf"], timer["histogram"]):
+                cumulative += count
+                report["timers"][name]["histogram"][bucket] = cumulative
+        return report
+
+    def get_prometheus(self, prefix="elastictmdb"):
+        report = self.get_report()
+        lines = []
+        lines.append("# TYPE {}_duration_seconds histogram".format(prefix))
+        for name, timer in report["timers"].items():
+            for bucket, count in timer["histogram"].items():
+                lines.append('{}_duration_seconds_bucket{{function="{}",le="{}"}} {}'.format(prefix, name, bucket, count))
+            lines.append('{}_duration_seconds_sum{{function="{}"}} {}'.format(prefix, name, timer["total_s"]))
+            lines.append('{}_duration_seconds_count{{function="{}"}} {}'.format(prefix, name, timer["count"]))
+        lines.append("# TYPE {}_errors_total counter".format(prefix))
+        for name, timer in report["timers"].items():
+            lines.append('{}_errors_total{{function="{}"}} {}'.format(prefix, name, timer["errors"]))
+        for name, value in sorted(report["counters"].items()):
+            lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+            lines.append("{}_{}_total {}".format(prefix, name, value))
+        return "\n".join(lines) + "\n"
+
+# Metrics of the process, shared by all instances
+registry = Metrics()
+timed = registry.timed
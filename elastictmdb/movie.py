@@ -9,10 +9,6 @@ class Movie(ElasticTMDB):
         self.config["initial_cache_tmdb"] = initialCacheTMDB
         self.load_config()
 
-        # Check for indices in elastic search. If none found create them.
-        self.check_index(indexName=self.config["title_index"], indexMappingFile="title.json")
-        self.check_index(indexName=self.config["search_index"], indexMappingFile="search.json")
-
         # Load template
         self.description_template = self.load_template(templateFile=self.config["description_template"])
         self.subtitle_template = self.load_template(templateFile=self.config["subtitle_template"])
@@ -24,5 +20,5 @@ class Movie(ElasticTMDB):
         self.attrib["alt_titles"] = "titles"
         self.attrib["date"] = "release_date"
 
-    def search(self, search):
-        return self.search_title(search=search)
+    def search(self, search, prefetched=None):
+        return self.search_title(search=search, prefetched=prefetched)
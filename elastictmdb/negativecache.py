@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+class NegativeCache(object):
+    # Fields of a search used to find the title. Episode details are not part of the key so that all the episodes of
+    # a show which is not found share the same entry
+    searchFields = ["title", "year", "country", "director", "actor", "other"]
+
+    def __init__(self, filename, config):
+        self.config = config
+        self.ttl = self.config["negative_cache_days"] * 86400
+
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS search (key TEXT PRIMARY KEY, title_type TEXT, searched REAL)")
+        # Titles of each search, so that searches are removed when a title with the same name is cached
+        self.db.execute("CREATE TABLE IF NOT EXISTS search_title (key TEXT, title_type TEXT, title TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS search_title_title ON search_title (title)")
+        # Expired searches are removed when opening so the file does not grow with programmes no longer aired
+        self.db.execute("DELETE FROM search WHERE searched < ?", (time.time() - self.ttl,))
+        self.db.execute("DELETE FROM search_title WHERE key NOT IN (SELECT key FROM search)")
+
+        self.lookups = 0
+        self.hits = 0
+        self.added = 0
+        self.removed = 0
+        # Searches skipped by this instance
+        self.skipped = set()
+
+    def get_key(self, search):
+        # Searches differing only in case, spacing or type of the year are the same search
+        titleSearch = {key: value for key, value in search.items() if key in self.searchFields}
+        return json.dumps([self.config["title_type"], self.normalise_search(search=titleSearch)], sort_keys=True)
+
+    def normalise_search(self, search):
+        if isinstance(search, dict):
+            return {key: self.normalise_search(search=value) for key, value in search.items()}
+        elif isinstance(search, list):
+            return [self.normalise_search(search=value) for value in search]
+        return self.normalise_title(title=search)
+
+    def normalise_title(self, title):
+        return " ".join(str(title).split()).casefold()
+
+    def contains(self, key):
+        with self.lock:
+            self.lookups += 1
+            row = self.db.execute("SELECT searched FROM search WHERE key = ?", (key,)).fetchone()
+            if row and time.time() - row[0] < self.ttl:
+                self.hits += 1
+                return True
+        return False
+
+    def first_skip(self, key):
+        # Return True the first time a search is skipped
+        with self.lock:
+            if key in self.skipped:
+                return False
+            self.skipped.add(key)
+            return True
+
+    def add(self, key, titles):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.execute("INSERT OR REPLACE INTO search (key, title_type, searched) VALUES (?, ?, ?)", (key, self.config["title_type"], time.time()))
+            self.db.execute("DELETE FROM search_title WHERE key = ?", (key,))
+            self.db.executemany("INSERT INTO search_title (key, title_type, title) VALUES (?, ?, ?)",
+                                [(key, self.config["title_type"], title) for title in {self.normalise_title(title=title) for title in titles}])
+            self.db.execute("COMMIT")
+            self.added += 1
+
+    def remove(self, key):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM search WHERE key = ?", (key,))
+            self.db.execute("DELETE FROM search_title WHERE key = ?", (key,))
+            self.db.execute("COMMIT")
+
+    def remove_titles(self, titles):
+        # Remove searches for any of the titles (or aliases) of a title just cached, which could find it now
+        titles = list({self.normalise_title(title=title) for title in titles if title})
+        if not titles:
+            return
+        with self.lock:
+            self.db.execute("BEGIN")
+            keys = self.db.execute("SELECT key FROM search_title WHERE title_type = ? AND title IN ({})".format(", ".join("?" * len(titles))),
+                                   [self.config["title_type"]] + titles).fetchall()
+            self.db.executemany("DELETE FROM search WHERE key = ?", keys)
+            self.db.executemany("DELETE FROM search_title WHERE key = ?", keys)
+            self.db.execute("COMMIT")
+            self.removed += len(keys)
+
+    def log_stats(self):
+        with self.lock:
+            if self.lookups:
+                logging.info("Failed {} searches skipped {} of {} ({:.1%}) - Added {} - Removed {}".format(self.config["title_type"], self.hits, self.lookups, self.hits / self.lookups, self.added, self.removed))
@@ -0,0 +1,99 @@
+import logging
+import os
+import struct
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class RateLimiter(object):
+    # Token bucket allowing a burst of requests and then a steady rate of requests per second. When a file is given
+    # the bucket is kept in it so that it is shared by all the processes using the same file
+    stateFormat = "dd"
+
+    def __init__(self, rate, burst, filename=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+        self.filename = None
+        self.fileObj = None
+        self.pid = None
+        if filename:
+            if fcntl:
+                if os.path.dirname(filename):
+                    os.makedirs(os.path.dirname(filename), exist_ok=True)
+                self.filename = filename
+            else:
+                logging.warning("File locking not supported, TMDB rate limit is not shared with other processes")
+
+        self.throttled = 0.0
+        self.throttledRequests = 0
+
+    def acquire(self):
+        # Wait until a token is available
+        waited = 0.0
+        while True:
+            with self.lock:
+                if self.filename:
+                    wait = self.take_shared()
+                else:
+                    wait = self.take()
+                if not wait:
+                    if waited:
+                        self.throttled += waited
+                        self.throttledRequests += 1
+                    return waited
+            time.sleep(wait)
+            waited += wait
+
+    def take(self):
+        # Refill tokens for the time elapsed and take one. Return how long to wait if no token is available
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take_shared(self):
+        # Same as take, with the bucket read from and written to the shared file while it is locked. Wall clock time
+        # is used since monotonic time is not comparable between processes
+        if self.pid != os.getpid():
+            # Locks are held by open files, a forked process has to open the file again for the lock to exclude
+            # its parent
+            self.fileObj = os.fdopen(os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644), "r+b")
+            self.pid = os.getpid()
+        fcntl.flock(self.fileObj, fcntl.LOCK_EX)
+        try:
+            self.fileObj.seek(0)
+            state = self.fileObj.read(struct.calcsize(self.stateFormat))
+            now = time.time()
+            if len(state) == struct.calcsize(self.stateFormat):
+                tokens, updated = struct.unpack(self.stateFormat, state)
+                tokens = min(self.burst, tokens + max(0, now - updated) * self.rate)
+            else:
+                tokens = self.burst
+
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+
+            self.fileObj.seek(0)
+            self.fileObj.truncate()
+            self.fileObj.write(struct.pack(self.stateFormat, tokens, now))
+            self.fileObj.flush()
+            return wait
+        finally:
+            fcntl.flock(self.fileObj, fcntl.LOCK_UN)
+
+    def get_stats(self):
+        with self.lock:
+            return {"throttled_s": round(self.throttled, 3), "throttled_requests": self.throttledRequests}
@@ -0,0 +1,157 @@
+import email.utils
+import logging
+import re
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .httpcache import ResponseCache
+
+class TMDB(object):
+    # Responses retried after a delay, rate limited and server errors
+    retryStatuses = {429, 500, 502, 503, 504}
+    # Max seconds waited before retrying a request
+    retryDelayMax = 120
+
+    def __init__(self, config, headers, semaphore, rateLimiter=None):
+        self.config = config
+        self.semaphore = semaphore
+        self.rateLimiter = rateLimiter
+        self.baseUrl = "https://api.themoviedb.org/3/"
+
+        # Keep-alive session with a connection pool, retrying on connection errors. Rate limiting and server errors are
+        # retried by get so that retries go through the rate limiter and do not hold the semaphore while waiting
+        retry = Retry(total=self.config["tmdb_retries"],
+                      connect=self.config["tmdb_retries"],
+                      read=0,
+                      status=0,
+                      redirect=False,
+                      allowed_methods=["GET"],
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.config["tmdb_pool_size"],
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.mount("https://", adapter)
+
+        # Optional on disk cache of responses
+        self.cache = None
+        if self.config["tmdb_cache_file"]:
+            self.cache = ResponseCache(filename=self.config["tmdb_cache_file"], config=self.config)
+
+        # Per endpoint statistics
+        self.lock = threading.Lock()
+        self.endPointStats = {}
+        self.cacheHits = 0
+        self.cacheRevalidated = 0
+
+    def get(self, endPoint, params):
+        cached = None
+        headers = {}
+        if self.cache:
+            cacheKey = self.cache.get_key(endPoint=endPoint, params=params)
+            cached = self.cache.get(key=cacheKey, endPoint=endPoint)
+            if cached:
+                if cached["fresh"]:
+                    with self.lock:
+                        self.cacheHits += 1
+                    return 200, cached["body"]
+                # Stale response, ask TMDB to return it only if it was modified
+                if cached["etag"]:
+                    headers["If-None-Match"] = cached["etag"]
+
+        for attempt in range(self.config["tmdb_retries"] + 1):
+            if self.rateLimiter:
+                self.rateLimiter.acquire()
+            with self.semaphore:
+                startTime = time.time()
+                try:
+                    response = self.session.get("{}{}".format(self.baseUrl, endPoint), params=params, headers=headers,
+                                                timeout=(self.config["tmdb_connect_timeout"], self.config["tmdb_read_timeout"]))
+                finally:
+                    self.add_stat(endPoint=endPoint, duration=time.time() - startTime)
+            if response.status_code not in self.retryStatuses or attempt == self.config["tmdb_retries"]:
+                break
+            delay = self.get_retry_delay(response=response, attempt=attempt)
+            logging.debug("TMDB {} returned {}, retrying in {:.1f}s".format(endPoint, response.status_code, delay))
+            time.sleep(delay)
+
+        if response.status_code == 304 and cached:
+            self.cache.touch(key=cacheKey)
+            with self.lock:
+                self.cacheRevalidated += 1
+            return 200, cached["body"]
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if self.cache and response.status_code == 200 and body is not None:
+            self.cache.set(key=cacheKey, endPoint=endPoint, etag=response.headers.get("ETag"), body=response.text)
+        return response.status_code, body
+
+    def get_retry_delay(self, response, attempt):
+        # Retry-After header is honoured when present (seconds or HTTP date), otherwise exponential backoff
+        retryAfter = response.headers.get("Retry-After")
+        delay = None
+        if retryAfter:
+            try:
+                delay = float(retryAfter)
+            except ValueError:
+                try:
+                    delay = email.utils.parsedate_to_datetime(retryAfter).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+        if delay is None:
+            delay = self.config["tmdb_backoff_factor"] * (2 ** attempt)
+        return min(max(delay, 0), self.retryDelayMax)
+
+    def add_stat(self, endPoint, duration):
+        # Group endpoints by replacing IDs so that stats are reported per type of request
+        endPoint = re.sub(r"/[0-9]+", "/{id}", endPoint)
+        with self.lock:
+            if endPoint not in self.endPointStats:
+                self.endPointStats[endPoint] = {"count": 0, "total": 0.0, "max": 0.0}
+            stat = self.endPointStats[endPoint]
+            stat["count"] += 1
+            stat["total"] += duration
+            stat["max"] = max(stat["max"], duration)
+
+    def get_stats(self):
+        stats = {"endpoints": {}}
+        with self.lock:
+            stats["cache_hits"] = self.cacheHits
+            stats["cache_revalidated"] = self.cacheRevalidated
+            for endPoint, stat in self.endPointStats.items():
+                stats["endpoints"][endPoint] = {}
+                stats["endpoints"][endPoint]["count"] = stat["count"]
+                stats["endpoints"][endPoint]["avg_ms"] = round(stat["total"] / stat["count"] * 1000, 1)
+                stats["endpoints"][endPoint]["max_ms"] = round(stat["max"] * 1000, 1)
+
+        # Connections opened vs requests sent on the pool gives the reuse rate
+        pool = self.session.get_adapter(self.baseUrl).poolmanager.connection_from_url(self.baseUrl)
+        stats["requests"] = pool.num_requests
+        stats["connections"] = pool.num_connections
+        if pool.num_requests:
+            stats["connection_reuse"] = round(1 - (pool.num_connections / pool.num_requests), 3)
+        else:
+            stats["connection_reuse"] = 0.0
+
+        if self.rateLimiter:
+            stats.update(self.rateLimiter.get_stats())
+        return stats
+
+    def log_stats(self):
+        stats = self.get_stats()
+        for endPoint, stat in sorted(stats["endpoints"].items()):
+            logging.info("TMDB {} - Requests {} - Avg {}ms - Max {}ms".format(endPoint, stat["count"], stat["avg_ms"], stat["max_ms"]))
+        logging.info("TMDB requests {} - Connections opened {} - Connection reuse {:.1%}".format(stats["requests"], stats["connections"], stats["connection_reuse"]))
+        if self.rateLimiter:
+            logging.info("TMDB requests throttled {} - Time throttled {:.1f}s".format(stats["throttled_requests"], stats["throttled_s"]))
+        if self.cache:
+            logging.info("TMDB cache hits {} - Revalidated {}".format(stats["cache_hits"], stats["cache_revalidated"]))
+
+    def close(self):
+        self.session.close()
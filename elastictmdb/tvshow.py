@@ -1,6 +1,8 @@
 import logging
 import datetime
+import json
 from .__init__ import ElasticTMDB
+from .metrics import timed
 
 class Tvshow(ElasticTMDB):
     def __init__(self, initialCacheTMDB=True):
@@ -26,8 +28,8 @@ class Tvshow(ElasticTMDB):
         self.attrib["alt_titles"] = "results"
         self.attrib["date"] = "first_air_date"
 
-    def search(self, search):
-        tvshow = self.search_title(search=search)
+    def search(self, search, prefetched=None):
+        tvshow = self.search_title(search=search, prefetched=prefetched)
         if tvshow:
             episode = self.search_episode(tvshow=tvshow, search=search)
             if episode:
@@ -47,6 +49,14 @@ class Tvshow(ElasticTMDB):
             return tvshow
 
     def query_episode(self, tvshow, search):
+        # Episodes found recently are kept in memory until an episode of the show is written
+        cacheKey = ("episode", tvshow["_source"]["ids"]["tmdb"], json.dumps([search.get(key) for key in ["season", "episode", "subtitle", "episode_year"]]))
+        cacheGroup = ("episode", tvshow["_source"]["ids"]["tmdb"])
+        result = self.recordCache.get(key=cacheKey)
+        if result:
+            return result
+        generation = self.recordCache.get_generation(key=cacheKey, group=cacheGroup)
+
         # Search for episode in elasticsearch
         query = {"from": 0, "size": 1, "query": {}}
         query["query"]["bool"] = {}
@@ -74,6 +84,7 @@ class Tvshow(ElasticTMDB):
         result = self.get_record_by_query(index=self.config["episode_index"], query=query)
 
         if result["hits"]["total"]["value"] > 0:
+            self.recordCache.set(key=cacheKey, value=result, generation=generation, group=cacheGroup)
             logging.debug("Found episode {} (S{:02d}E{:02d}) in elasticsearch".format(tvshow["_source"]["title"], result["hits"]["hits"][0]["_source"]["season"], result["hits"]["hits"][0]["_source"]["episode"]))
             return result
 
@@ -89,6 +100,7 @@ class Tvshow(ElasticTMDB):
         else:
             return False
 
+    @timed("search_episode")
     def search_episode(self, tvshow, search):
         performSearch = search.get("force")
         result = None
@@ -109,7 +121,7 @@ class Tvshow(ElasticTMDB):
                         record["season"] = search["season"]
                         record["episode"] = -1
                         # Save record as a stub to avoid querying this season again
-                        self.index_record(index=self.config["episode_index"], record=record)
+                        self.index_record(index=self.config["episode_index"], record=record, recordId=self.get_episode_id(tvshowId=record["tvshow_id"], season=record["season"], episode=record["episode"]))
 
         if not result:
             # Query again to get data
@@ -154,4 +166,8 @@ class Tvshow(ElasticTMDB):
                             record["rating"]["tmdb"]["votes"] = episode["vote_count"]
                             record["rating"]["tmdb"]["average"] = episode["vote_average"]
                         record["ids"] = {"tmdb": episode["id"]}
-                        self.index_record(index=self.config["episode_index"], record=record)
+                        # Episodes cached again replace the existing record
+                        self.index_record(index=self.config["episode_index"], record=record, recordId=self.get_episode_id(tvshowId=record["tvshow_id"], season=record["season"], episode=record["episode"]))
+
+    def get_episode_id(self, tvshowId, season, episode):
+        return "{}:{}:{}".format(tvshowId, season, episode)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+from elasticsearch import helpers
+from elastictmdb.movie import Movie
+from elastictmdb.tvshow import Tvshow
+
+argParser = argparse.ArgumentParser()
+argParser._action_groups.pop()
+optional = argParser.add_argument_group('optional arguments')
+optional.add_argument("-m", "--movie", action="store_true", help="Migrate Only Movie Indices")
+optional.add_argument("-t", "--tvshow", action="store_true", help="Migrate Only TV Indices")
+optional.add_argument("-n", "--dry-run", action="store_true", help="Only report the records which would be migrated")
+optional.add_argument("-d", "--debug", action="store_true", help="Enable debug output")
+args = argParser.parse_args()
+
+if args.debug:
+    logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(message)s")
+else:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+def get_new_id(titleObj, index, record):
+    # ID the record is written with by the current version, None if the record can not be migrated
+    source = record["_source"]
+    if index == titleObj.config["title_index"]:
+        if "ids" in source:
+            return titleObj.get_title_id(tmdbId=source["ids"]["tmdb"])
+    elif index == titleObj.config["search_index"]:
+        if "person" in source:
+            return titleObj.get_search_id(field="person", value=source["person"], year=source["year"])
+        if "title" in source:
+            return titleObj.get_search_id(field="title", value=source["title"], year=source["year"])
+    elif index == titleObj.config.get("episode_index"):
+        return titleObj.get_episode_id(tvshowId=source["tvshow_id"], season=source["season"], episode=source["episode"])
+    return None
+
+def migrate_index(titleObj, index, dryRun):
+    # First pass finds the newest record of each new ID, duplicates created with generated IDs are dropped
+    newest = {}
+    for record in helpers.scan(titleObj.es, index=index, _source_includes=["ids", "person", "title", "year", "tvshow_id", "season", "episode", "@timestamp"]):
+        newId = get_new_id(titleObj=titleObj, index=index, record=record)
+        if not newId:
+            logging.warning("Unable to get ID for record {} in {}".format(record["_id"], index))
+            continue
+        if newId not in newest or record["_source"].get("@timestamp", "") > newest[newId][1]:
+            newest[newId] = (record["_id"], record["_source"].get("@timestamp", ""))
+
+    # Second pass writes the newest records with their new ID and deletes all records with an old ID
+    def actions():
+        for record in helpers.scan(titleObj.es, index=index):
+            newId = get_new_id(titleObj=titleObj, index=index, record=record)
+            if not newId or record["_id"] == newId:
+                continue
+            if newest[newId][0] == record["_id"]:
+                yield {"_op_type": "index", "_index": index, "_id": newId, "_source": record["_source"]}
+            yield {"_op_type": "delete", "_index": index, "_id": record["_id"]}
+
+    if dryRun:
+        migrated = sum(1 for action in actions() if action["_op_type"] == "index")
+        deleted = sum(1 for action in actions() if action["_op_type"] == "delete")
+        logging.info("{} - {} records would be written with a new ID and {} records with an old ID deleted".format(index, migrated, deleted))
+        return
+
+    success, errors = helpers.bulk(titleObj.es, actions(), chunk_size=titleObj.config["bulk_size"], stats_only=False, raise_on_error=False)
+    for error in errors:
+        for opType, item in error.items():
+            logging.error("Error migrating record in {} (ID: {}) - Status {} - {}".format(item.get("_index"), item.get("_id"), item.get("status"), item.get("error")))
+    titleObj.es.indices.refresh(index=index)
+    logging.info("{} - {} records written or deleted - Errors {}".format(index, success, len(errors)))
+
+titleObjs = []
+if args.movie:
+    titleObjs.append(Movie())
+if args.tvshow:
+    titleObjs.append(Tvshow())
+if not args.movie and not args.tvshow:
+    titleObjs.append(Movie())
+    titleObjs.append(Tvshow())
+
+for titleObj in titleObjs:
+    indices = [titleObj.config["title_index"], titleObj.config["search_index"]]
+    if "episode_index" in titleObj.config:
+        indices.append(titleObj.config["episode_index"])
+    for index in indices:
+        logging.info("Migrating {}".format(index))
+        migrate_index(titleObj=titleObj, index=index, dryRun=args.dry_run)
@@ -1,97 +1,200 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import hashlib
+import json
 import logging
+import multiprocessing
+import multiprocessing.util
+import threading
+import time
 import re
+import sqlite3
 from lxml import etree
 from elastictmdb.movie import Movie
 from elastictmdb.tvshow import Tvshow
+from elastictmdb.metrics import registry, timed
+import calendar
 import collections
-import datetime
+import functools
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 
 class epg(object):
-    def __init__(self, force=False):
+    def __init__(self, force=False, concurrency=8, categoriesFile=None, stateFile=None, stateTtl=24):
         # Initialise ElasticTMDB Objects
         self.movie = Movie()
         self.tvshow = Tvshow()
 
         self.force = force
+        self.classifier = classifier(mappingFile=categoriesFile)
+
+        # Programmes are searched concurrently by a pool of threads. Requests to elasticsearch and TMDB are
+        # further limited by the es_concurrency and tmdb_concurrency settings
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # Programmes are searched in batches, the elasticsearch queries of a batch being sent together
+        self.batchSize = concurrency * 2
+
+        # Results of searches done during this run, so that repeat airings of a programme are not searched again.
+        # Least recently used results are removed once there are more than programme_cache_size
+        self.searches = collections.OrderedDict()
+        self.searchesSize = self.movie.config["programme_cache_size"]
+        self.searchesLock = threading.Lock()
+        self.searchCount = 0
+        self.searchReused = 0
+
+        # Enriched programmes of previous runs, unchanged programmes are written from it without searching
+        self.state = None
+        if stateFile:
+            self.state = epgstate(filename=stateFile, ttl=stateTtl, force=force)
 
         self.outputXmltv = xmltv()
 
-    def process_file(self, filename):
-        inputXmltv = xmltv()
-        inputXmltv.load_xmltv(filename=filename)
+    def open_file(self, filename):
+        self.outputXmltv.open_xmltv(filename=filename)
 
+    def process_channels(self, filename):
         # Add channels to output file
-        self.outputXmltv.channels += inputXmltv.channels
+        inputXmltv = xmltv()
+        for channelElement in inputXmltv.load_channels(filename=filename):
+            self.outputXmltv.write_element(element=channelElement)
+
+    def process_file(self, filename):
+        inputXmltv = xmltv()
 
         # Parse programmes
-        for programmeElement in inputXmltv.programmes:
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.process_programmes(inputXmltv=inputXmltv, filename=filename))
+        finally:
+            loop.close()
+
+    async def process_programmes(self, inputXmltv, filename):
+        loop = asyncio.get_event_loop()
+        pending = collections.deque()
+        batch = None
+        for programmeElement in inputXmltv.load_programmes(filename=filename):
+            registry.increment(name="programmes")
+            programmeHash = None
+            if self.state:
+                # Hash is taken before the programme is modified
+                programmeHash = self.state.get_hash(element=programmeElement)
+                stored = self.state.get(programmeHash=programmeHash)
+                if stored is not None:
+                    registry.increment(name="programmes_from_state")
+                    pending.append((etree.fromstring(stored), None, None, None))
+                    continue
+
+            search = self.prepare_programme(element=programmeElement)
+            if search:
+                registry.increment(name="programmes_searched")
+                if not batch:
+                    batch = {"searches": [], "future": None}
+                pending.append((programmeElement, batch, len(batch["searches"]), programmeHash))
+                batch["searches"].append(search)
+                if len(batch["searches"]) >= self.batchSize:
+                    self.submit_batch(loop=loop, batch=batch)
+                    batch = None
+            else:
+                pending.append((programmeElement, None, None, programmeHash))
+
+            # Keep a window of programmes in flight, larger than the number of threads so a slow programme
+            # does not stall the others, and output them in the same order as the input file
+            if len(pending) >= self.batchSize * 4:
+                await self.output_programme(loop, *pending.popleft())
+
+        while pending:
+            await self.output_programme(loop, *pending.popleft())
+
+    def submit_batch(self, loop, batch):
+        # Batch is searched by a thread of the pool, which returns the future of each programme of the batch
+        batch["future"] = loop.run_in_executor(self.executor, self.search_programmes, batch["searches"])
+
+    def prepare_programme(self, element):
+        # Return the object and request to search with if programme is a movie or a TV show, other programmes are
+        # written unchanged
+        try:
+            programmeType = self.classifier.get_programme_type(element=element)
+            if programmeType == "movie":
+                return self.movie, self.process_movie(element=element)
+            elif programmeType == "tvshow":
+                return self.tvshow, self.process_tvshow(element=element)
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    async def output_programme(self, loop, element, batch, searchIndex, programmeHash):
+        if batch:
             try:
-                programme = inputXmltv.parse_element(element=programmeElement)
-                programmeType = self.get_programme_type(programme=programme)
-                if programmeType == "movie":
-                    programme = self.process_movie(programme=programme)
-                elif programmeType == "tvshow":
-                    programme = self.process_tvshow(programme=programme)
-                self.outputXmltv.build_programme_element(record=programme)
+                # Programmes of a batch not full yet are searched once the first of them is output
+                if not batch["future"]:
+                    self.submit_batch(loop=loop, batch=batch)
+                searchFutures = await batch["future"]
+                self.update_programme(element=element, result=await asyncio.wrap_future(searchFutures[searchIndex]))
+                # Only searched programmes are stored, other programmes are written unchanged anyway
+                if programmeHash:
+                    self.state.set(programmeHash=programmeHash, output=etree.tostring(element))
             except Exception:
                 logging.error(traceback.format_exc())
-
-    def get_programme_type(self, programme):
-        # Ignore the catagories
-        for category in programme.get("category", []):
-            regex = re.search("sport|news", category["_text"], flags=re.IGNORECASE)
-            if regex:
-                return None
-
-        # Loop through categories to detect TV Shows
-        for category in programme.get("category", []):
-            regex = re.search("tvshow|episode|telefilm|serial|series", category["_text"], flags=re.IGNORECASE)
-            if regex:
-                return "tvshow"
-
-        # Loop again through categories to detect movies
-        for category in programme.get("category", []):
-            regex = re.search("movie|cinema|kino|featurefilm|cine", category["_text"], flags=re.IGNORECASE)
-            if regex:
-                return "movie"
-            regex = re.search("documentary", category["_text"], flags=re.IGNORECASE)
-            if regex:
-                return self.get_programme_type_by_duration(start=programme["_attrib"]["start"], stop=programme["_attrib"]["stop"])
-
-        # If episode-num tag present then consider it a tvshow
-        if "episode-num" in programme:
-            return "tvshow"
-
-        # If credits tag is present then use the duration to determine if its a tvshow or movie
-        if "credits" in programme:
-            return self.get_programme_type_by_duration(start=programme["_attrib"]["start"], stop=programme["_attrib"]["stop"])
-
-    def get_programme_type_by_duration(self, start, stop):
-        if self.get_unixtime_from_ts(stop) - self.get_unixtime_from_ts(start) >= 4200:
-            return "movie"
-        else:
-            return "tvshow"
-
-    def save_file(self, filename):
-        self.outputXmltv.save_xmltv(filename=filename)
-
-    def process_movie(self, programme):
+        self.outputXmltv.write_element(element=element)
+
+    def process_programme_strings(self, programmeStrings):
+        # Process a shard of serialised programmes sent by the parent process and return them serialised in the
+        # same order, along with whether the programme was searched. The shard is searched as a single batch
+        programmes = []
+        for programmeString in programmeStrings:
+            element = etree.fromstring(programmeString)
+            search = self.prepare_programme(element=element)
+            if search:
+                registry.increment(name="programmes_searched")
+            programmes.append((element, search))
+
+        searchFutures = iter(self.search_programmes(searches=[search for element, search in programmes if search]))
+        searchFutures = [(element, next(searchFutures) if search else None) for element, search in programmes]
+
+        results = []
+        for element, searchFuture in searchFutures:
+            searched = False
+            if searchFuture:
+                try:
+                    self.update_programme(element=element, result=searchFuture.result())
+                    searched = True
+                except Exception:
+                    logging.error(traceback.format_exc())
+            results.append((etree.tostring(element), searched))
+        return results
+
+    def save_file(self):
+        self.outputXmltv.save_xmltv()
+        self.movie.flush()
+        self.tvshow.flush()
+        if self.state:
+            self.state.close()
+
+    def log_stats(self):
+        if self.searchCount:
+            logging.info("Programme searches {} - Reused {} ({:.1%})".format(self.searchCount, self.searchReused, self.searchReused / self.searchCount))
+        if self.state:
+            self.state.log_stats()
+        for titleObj in [self.movie, self.tvshow]:
+            titleObj.recordCache.log_stats()
+            if titleObj.negativeCache:
+                titleObj.negativeCache.log_stats()
+        self.movie.tmdb.log_stats()
+        self.tvshow.tmdb.log_stats()
+        self.movie.bulkWriter.log_stats()
+        self.tvshow.bulkWriter.log_stats()
+
+    def process_movie(self, element):
+        programme = self.outputXmltv.parse_element(element=element)
         request = self.build_query(programme=programme)
         if "date" in programme:
             request["year"] = programme["date"][0]["_text"][:4]
 
-        response = self.movie.search(search=request)
-        if response:
-            programme["desc"] = [self.outputXmltv.add_text_element(text=self.movie.render_template(record=response, template="description"), lang="en")]
-            programme["sub-title"] = [self.outputXmltv.add_text_element(text=self.movie.render_template(record=response, template="subtitle"), lang="en")]
-            programme = self.update_programme(programme=programme, response=response)
-
-        return programme
+        return request
 
-    def process_tvshow(self, programme):
+    def process_tvshow(self, element):
+        programme = self.outputXmltv.parse_element(element=element)
         request = self.build_query(programme=programme)
         if "episode-num" in programme:
             for episodeNum in programme["episode-num"]:
@@ -103,7 +206,7 @@ class epg(object):
                     request["episode"] = int(regex.group(1))
             if "season" in request and "episode" in request:
                 episodeNum = "S{:02d}E{:02d}".format(request["season"], request["episode"])
-                programme["episode-num"] = [self.outputXmltv.add_episode_num_element(episodeNum=episodeNum)]
+                self.outputXmltv.replace_elements(element=element, tag="episode-num", newElements=[self.outputXmltv.add_episode_num_element(episodeNum=episodeNum)])
 
         if "sub-title" in programme:
             request["subtitle"] = []
@@ -115,19 +218,73 @@ class epg(object):
             for episodeYear in programme["date"]:
                 request["episode_year"].append(episodeYear["_text"][:4])
 
-        response = self.tvshow.search(search=request)
-        if response:
-            programme["desc"] = [self.outputXmltv.add_text_element(text=self.tvshow.render_template(record=response, template="description"), lang="en")]
-            programme["sub-title"] = [self.outputXmltv.add_text_element(text=self.tvshow.render_template(record=response, template="subtitle"), lang="en")]
-
-            # Add episode number
-            if "season" in response and "episode" in response:
-                episodeNum = "S{:02d}E{:02d}".format(response["season"], response["episode"])
-                programme["episode-num"] = [self.outputXmltv.add_episode_num_element(episodeNum=episodeNum)]
-
-            programme = self.update_programme(programme=programme, response=response)
+        return request
 
-        return programme
+    def get_search_key(self, titleObj, request):
+        # Normalise request to match airings listed with different case or spacing. Key is generated before
+        # searching since the search can modify the request
+        return json.dumps([titleObj.config["title_type"], self.normalise_request(request=request)], sort_keys=True)
+
+    def search_programmes(self, searches):
+        # Search a batch of programmes (pairs of object and request) and return a future of the result of each.
+        # Repeat airings share the future of the first airing searched, during this run or earlier in the batch
+        searchKeys = [self.get_search_key(titleObj=titleObj, request=request) for titleObj, request in searches]
+        futures = []
+        # Searches to send by object, in the same order as the batch
+        titleSearches = collections.OrderedDict()
+        with self.searchesLock:
+            for (titleObj, request), searchKey in zip(searches, searchKeys):
+                self.searchCount += 1
+                future = self.searches.get(searchKey)
+                if future is not None:
+                    self.searchReused += 1
+                    self.searches.move_to_end(searchKey)
+                else:
+                    future = Future()
+                    self.searches[searchKey] = future
+                    titleSearches.setdefault(titleObj, []).append((searchKey, request, future))
+                    # Searches still in progress can be removed too, repeat airings would then search again
+                    while len(self.searches) > self.searchesSize:
+                        self.searches.popitem(last=False)
+                futures.append(future)
+
+        for titleObj, pending in titleSearches.items():
+            requests = [request for searchKey, request, future in pending]
+            try:
+                searchFutures = titleObj.search_many(searches=requests, executor=self.executor)
+            except Exception:
+                # Programmes are still searched one by one
+                logging.error(traceback.format_exc())
+                searchFutures = [self.executor.submit(titleObj.search, search=request) for request in requests]
+            for (searchKey, request, future), searchFuture in zip(pending, searchFutures):
+                searchFuture.add_done_callback(functools.partial(self.complete_search, titleObj=titleObj, searchKey=searchKey, future=future))
+        return futures
+
+    def complete_search(self, searchFuture, titleObj, searchKey, future):
+        # Render the templates of a search done and set the result of the programmes waiting for it
+        try:
+            result = None
+            response = searchFuture.result()
+            if response:
+                result = {}
+                result["response"] = response
+                result.update(titleObj.render_templates(record=response))
+            future.set_result(result)
+        except Exception as e:
+            # Do not keep failures so that the next airing is searched again
+            with self.searchesLock:
+                if self.searches.get(searchKey) is future:
+                    del self.searches[searchKey]
+            future.set_exception(e)
+
+    def normalise_request(self, request):
+        if isinstance(request, dict):
+            return {key: self.normalise_request(request=value) for key, value in request.items()}
+        elif isinstance(request, list):
+            return [self.normalise_request(request=value) for value in request]
+        elif isinstance(request, str):
+            return " ".join(request.split()).casefold()
+        return request
 
     def build_query(self, programme):
         # Build query for ElasticTMDB
@@ -163,95 +320,360 @@ class epg(object):
 
         return request
 
-    def update_programme(self, programme, response):
+    def update_programme(self, element, result):
+        if not result:
+            return
+        response = result["response"]
+
+        # Replace description and subtitle with rendered templates
+        self.outputXmltv.replace_elements(element=element, tag="desc", newElements=[self.outputXmltv.add_text_element(tag="desc", text=result["description"], lang="en")])
+        self.outputXmltv.replace_elements(element=element, tag="sub-title", newElements=[self.outputXmltv.add_text_element(tag="sub-title", text=result["subtitle"], lang="en")])
+
+        # Add episode number
+        if "season" in response and "episode" in response:
+            episodeNum = "S{:02d}E{:02d}".format(response["season"], response["episode"])
+            self.outputXmltv.replace_elements(element=element, tag="episode-num", newElements=[self.outputXmltv.add_episode_num_element(episodeNum=episodeNum)])
+
         # Replace Title
-        programme["title"] = [self.outputXmltv.add_text_element(text=response["_source"]["title"], lang="en")]
+        self.outputXmltv.replace_elements(element=element, tag="title", newElements=[self.outputXmltv.add_text_element(tag="title", text=response["_source"]["title"], lang="en")])
 
         # Replace Image
         if "image" in response["_source"]:
-            programme["icon"] = [self.outputXmltv.add_icon_element(url=response["_source"]["image"])]
+            self.outputXmltv.replace_elements(element=element, tag="icon", newElements=[self.outputXmltv.add_icon_element(url=response["_source"]["image"])])
 
         # Replace Credits
-        programmeCredits = {}
+        programmeCredits = etree.Element("credits")
         if "director" in response["_source"]["credits"]:
-            programmeCredits["director"] = []
             for director in response["_source"]["credits"]["director"]:
-                programmeCredits["director"].append(self.outputXmltv.add_text_element(text=director, lang=None))
+                programmeCredits.append(self.outputXmltv.add_text_element(tag="director", text=director, lang=None))
 
         if "actor" in response["_source"]["credits"]:
-            programmeCredits["actor"] = []
             for actor in response["_source"]["credits"]["actor"]:
-                programmeCredits["actor"].append(self.outputXmltv.add_text_element(text=actor, lang=None))
+                programmeCredits.append(self.outputXmltv.add_text_element(tag="actor", text=actor, lang=None))
 
-        if programmeCredits:
-            programme["credits"] = [programmeCredits]
+        if len(programmeCredits):
+            self.outputXmltv.replace_elements(element=element, tag="credits", newElements=[programmeCredits])
 
         # Replace year
-        programme["date"] = [self.outputXmltv.add_text_element(text=response["_source"]["year"])]
+        self.outputXmltv.replace_elements(element=element, tag="date", newElements=[self.outputXmltv.add_text_element(tag="date", text=response["_source"]["year"])])
 
         # Replace country
         if response["_source"]["country"]:
-            programme["country"] = []
+            countries = []
             for country in response["_source"]["country"]:
-                programme["country"].append(self.outputXmltv.add_text_element(text=country, lang="en"))
+                countries.append(self.outputXmltv.add_text_element(tag="country", text=country, lang="en"))
+            self.outputXmltv.replace_elements(element=element, tag="country", newElements=countries)
 
         # Replace categories
-        programme["category"] = []
+        categories = []
         for genre in response["_source"]["genre"]:
-            programme["category"].append(self.outputXmltv.add_text_element(text=genre, lang="en"))
+            categories.append(self.outputXmltv.add_text_element(tag="category", text=genre, lang="en"))
+        self.outputXmltv.replace_elements(element=element, tag="category", newElements=categories)
 
         # Replace rating
         if "rating" in response["_source"]:
-            programme["star-rating"] = self.outputXmltv.add_element_value_subelement(text="{}/10".format(response["_source"]["rating"]["tmdb"]["average"]))
-
-        return programme
-
-    def get_unixtime_from_ts(self, timestamp):
-        parsedTs = datetime.datetime.strptime(timestamp[0:13], "%Y%m%d%H%M%S")
-        if timestamp[15] == '-':
-            parsedTs += datetime.timedelta(hours=int(timestamp[16:18]), minutes=int(timestamp[18:20]))
-        elif timestamp[15] == '+':
-            parsedTs -= datetime.timedelta(hours=int(timestamp[16:18]), minutes=int(timestamp[18:20]))
-        return parsedTs.timestamp()
-
-class xmltv(object):
-    def __init__(self):
-        self.channels = []
-        self.programmes = []
-
-    def load_xmltv(self, filename):
-        logging.info("Parsing {}".format(filename))
-        parser = etree.XMLParser(remove_blank_text=True)
-        xmltvFile = etree.parse(filename, parser).getroot()
+            starRating = self.outputXmltv.add_element_value_subelement(tag="star-rating", text="{}/10".format(response["_source"]["rating"]["tmdb"]["average"]))
+            self.outputXmltv.replace_elements(element=element, tag="star-rating", newElements=[starRating])
+
+class classifier(object):
+    # Patterns matched against categories, combined in a single expression. The lookahead matches at every position
+    # so that overlapping keywords are all found
+    patterns = collections.OrderedDict()
+    patterns["ignore"] = "sport|news"
+    patterns["tvshow"] = "tvshow|episode|telefilm|serial|series"
+    patterns["movie"] = "movie|cinema|kino|featurefilm|cine"
+    patterns["documentary"] = "documentary"
+
+    def __init__(self, mappingFile=None):
+        regex = "|".join("(?P<{}>{})".format(programmeType, pattern) for programmeType, pattern in self.patterns.items())
+        self.regex = re.compile("(?=(?:{}))".format(regex), flags=re.IGNORECASE)
+
+        # Categories mapped to a type by the user take precedence over the patterns
+        self.mapping = {}
+        if mappingFile:
+            with open(mappingFile, "r") as mappingFileObj:
+                for category, programmeType in json.load(mappingFileObj).items():
+                    if programmeType not in self.patterns:
+                        raise ValueError("Invalid type {} for category {}. Valid types are {}".format(programmeType, category, ", ".join(self.patterns)))
+                    self.mapping[category.strip().casefold()] = programmeType
+            logging.info("Loaded {} category mappings from {}".format(len(self.mapping), mappingFile))
+
+    def get_category_types(self, category):
+        programmeType = self.mapping.get(category.strip().casefold())
+        if programmeType:
+            return {programmeType}
+        return {match.lastgroup for match in self.regex.finditer(category)}
+
+    def get_programme_type(self, element):
+        # Single pass through the categories. Ignored categories take precedence over TV shows, which take precedence
+        # over the first category detected as a movie or documentary
+        tvshow = False
+        movie = None
+        for category in element.iterfind("category"):
+            categoryTypes = self.get_category_types(category=category.text or "")
+            if "ignore" in categoryTypes:
+                return None
+            if "tvshow" in categoryTypes:
+                tvshow = True
+            if not movie:
+                if "movie" in categoryTypes:
+                    movie = "movie"
+                elif "documentary" in categoryTypes:
+                    movie = "documentary"
+
+        if tvshow:
+            return "tvshow"
+        if movie == "movie":
+            return "movie"
+        if movie == "documentary":
+            return self.get_programme_type_by_duration(start=element.get("start"), stop=element.get("stop"))
 
-        # Load channels
-        channels = xmltvFile.findall("channel")
-        logging.info("Found {} channels".format(len(channels)))
-        for channel in channels:
-            self.channels.append(channel)
+        # If episode-num tag present then consider it a tvshow
+        if element.find("episode-num") is not None:
+            return "tvshow"
 
-        # Load programmes
-        programmes = xmltvFile.findall("programme")
-        logging.info("Found {} programmes".format(len(programmes)))
-        for programme in programmes:
-            self.programmes.append(programme)
+        # If credits tag is present then use the duration to determine if its a tvshow or movie
+        if element.find("credits") is not None:
+            return self.get_programme_type_by_duration(start=element.get("start"), stop=element.get("stop"))
 
-    def save_xmltv(self, filename):
-        tvElement = etree.Element("tv")
+    def get_programme_type_by_duration(self, start, stop):
+        if self.get_unixtime_from_ts(stop) - self.get_unixtime_from_ts(start) >= 4200:
+            return "movie"
+        else:
+            return "tvshow"
 
-        # Save channels
-        for channel in self.channels:
-            tvElement.append(channel)
+    def get_unixtime_from_ts(self, timestamp):
+        # Parse XMLTV timestamps (YYYYmmddHHMMSS +HHMM) without strptime. Seconds and offset are optional
+        dateTime, _, offset = timestamp.strip().partition(" ")
+        unixtime = calendar.timegm((int(dateTime[0:4]), int(dateTime[4:6]), int(dateTime[6:8]), int(dateTime[8:10] or 0),
+                                    int(dateTime[10:12] or 0), int(dateTime[12:14] or 0), 0, 0, 0))
+        if len(offset) == 5:
+            offsetSeconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+            if offset[0] == "-":
+                unixtime += offsetSeconds
+            elif offset[0] == "+":
+                unixtime -= offsetSeconds
+        return unixtime
+
+# Each worker process has its own epg object with its own Movie and Tvshow instances
+workerEpg = None
+
+def init_worker(force, concurrency, categoriesFile, logLevel, logFile):
+    global workerEpg
+    logging.basicConfig(level=logLevel, filename=logFile, format="%(asctime)s %(message)s")
+    workerEpg = epg(force=force, concurrency=concurrency, categoriesFile=categoriesFile)
+    # atexit is not run by pool workers, so flush pending records through a multiprocessing finaliser
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+
+def close_worker():
+    workerEpg.movie.flush()
+    workerEpg.tvshow.flush()
+    workerEpg.log_stats()
+
+def process_worker_shard(programmeStrings):
+    # Metrics recorded while processing the shard are sent to the parent process with the programmes
+    return workerEpg.process_programme_strings(programmeStrings=programmeStrings), registry.collect(reset=True)
+
+def process_files_with_workers(inputFiles, outputFile, workers, force, concurrency, categoriesFile, logLevel, logFile, stateFile=None, stateTtl=24, shardSize=50):
+    # State is only accessed by the parent process, workers receive the programmes that were not found in it
+    state = None
+    if stateFile:
+        state = epgstate(filename=stateFile, ttl=stateTtl, force=force)
+
+    outputXmltv = xmltv()
+    outputXmltv.open_xmltv(filename=outputFile)
+    for filename in inputFiles:
+        for channelElement in outputXmltv.load_channels(filename=filename):
+            outputXmltv.write_element(element=channelElement)
+
+    pool = multiprocessing.Pool(processes=workers, initializer=init_worker, initargs=(force, concurrency, categoriesFile, logLevel, logFile))
+    try:
+        # Programmes of all files are split in shards and sent to the workers. A limited number of shards is kept in
+        # flight and results are written in the same order as the input
+        pending = collections.deque()
+        shard = []
+        for filename in inputFiles:
+            for programmeElement in outputXmltv.load_programmes(filename=filename):
+                registry.increment(name="programmes")
+                # Each programme of the shard is kept with its hash and stored output, if any
+                programmeHash = None
+                stored = None
+                if state:
+                    programmeHash = state.get_hash(element=programmeElement)
+                    stored = state.get(programmeHash=programmeHash)
+                    if stored is not None:
+                        registry.increment(name="programmes_from_state")
+                shard.append((etree.tostring(programmeElement), programmeHash, stored))
+                if len(shard) >= shardSize:
+                    pending.append(submit_worker_shard(pool=pool, shard=shard))
+                    shard = []
+                if len(pending) >= workers * 4:
+                    shardWritten, asyncResult = pending.popleft()
+                    write_worker_shard(shard=shardWritten, asyncResult=asyncResult, outputXmltv=outputXmltv, state=state)
+        if shard:
+            pending.append(submit_worker_shard(pool=pool, shard=shard))
+        while pending:
+            shardWritten, asyncResult = pending.popleft()
+            write_worker_shard(shard=shardWritten, asyncResult=asyncResult, outputXmltv=outputXmltv, state=state)
+    finally:
+        # Close instead of terminating so that workers flush their pending records
+        pool.close()
+        pool.join()
+
+    outputXmltv.save_xmltv()
+    if state:
+        state.close()
+        state.log_stats()
+
+def submit_worker_shard(pool, shard):
+    # Programmes found in the state are not sent to the workers
+    programmeStrings = [programmeString for programmeString, programmeHash, stored in shard if stored is None]
+    return shard, pool.apply_async(process_worker_shard, (programmeStrings,))
+
+def write_worker_shard(shard, asyncResult, outputXmltv, state):
+    results, metrics = asyncResult.get()
+    registry.merge(snapshot=metrics)
+    results = iter(results)
+    for programmeString, programmeHash, stored in shard:
+        if stored is None:
+            stored, searched = next(results)
+            if searched and programmeHash:
+                state.set(programmeHash=programmeHash, output=stored)
+        outputXmltv.write_element(element=etree.fromstring(stored))
+
+class epgstate(object):
+    # Enriched output of programmes keyed by a hash of the programme in the input file. Programmes are only looked
+    # up in a single thread so the connection is not shared
+    def __init__(self, filename, ttl=24, force=False):
+        self.ttl = ttl * 3600
+        # Programmes are searched again when forced, the state is still updated with the new output
+        self.force = force
 
-        # Save programme
-        for programme in self.programmes:
-            tvElement.append(programme)
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS programme (hash TEXT PRIMARY KEY, output BLOB, updated REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS programme_updated ON programme (updated)")
+        self.db.commit()
+        self.uncommitted = 0
+
+        self.lookups = 0
+        self.hits = 0
+        self.stored = 0
+
+    def get_hash(self, element):
+        # Canonical form so that formatting changes of the input file do not change the hash
+        return hashlib.sha1(etree.tostring(element, method="c14n")).hexdigest()
+
+    def get(self, programmeHash):
+        self.lookups += 1
+        if self.force:
+            return None
+        row = self.db.execute("SELECT output FROM programme WHERE hash = ? AND updated >= ?", (programmeHash, time.time() - self.ttl)).fetchone()
+        if row:
+            self.hits += 1
+            return row[0]
+        return None
+
+    def set(self, programmeHash, output):
+        self.db.execute("INSERT OR REPLACE INTO programme (hash, output, updated) VALUES (?, ?, ?)", (programmeHash, output, time.time()))
+        self.stored += 1
+        # Commit in batches, a commit for each programme would dominate the time spent
+        self.uncommitted += 1
+        if self.uncommitted >= 1000:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        # Remove expired programmes so the state only holds programmes of recent runs
+        cursor = self.db.execute("DELETE FROM programme WHERE updated < ?", (time.time() - self.ttl,))
+        logging.debug("Removed {} expired programmes from state".format(cursor.rowcount))
+        self.db.commit()
+        self.db.close()
+
+    def log_stats(self):
+        if self.lookups:
+            logging.info("Programmes in state {} of {} ({:.1%}) - Stored {}".format(self.hits, self.lookups, self.hits / self.lookups, self.stored))
+
+def save_metrics(metricsFile=None, prometheusFile=None):
+    # Report of time spent and calls made in each stage of processing, as JSON and/or Prometheus text format
+    if metricsFile:
+        with open(metricsFile, "w") as metricsFileObj:
+            json.dump(registry.get_report(), metricsFileObj, indent=2)
+        logging.info("Saved metrics to {}".format(metricsFile))
+    if prometheusFile:
+        with open(prometheusFile, "w") as prometheusFileObj:
+            prometheusFileObj.write(registry.get_prometheus())
+        logging.info("Saved Prometheus metrics to {}".format(prometheusFile))
 
-        # Save XML file
-        with open(filename, "wb") as xmlFileObj:
-            xmlFileObj.write(etree.tostring(tvElement, pretty_print=True, encoding="utf-8"))
+class xmltv(object):
+    # Order of programme subelements as defined by the XMLTV DTD
+    programmeElements = ["title", "sub-title", "desc", "credits", "date", "category", "keyword", "language", "orig-language",
+                         "length", "icon", "url", "country", "episode-num", "video", "audio", "previously-shown", "premiere",
+                         "last-chance", "new", "subtitles", "rating", "star-rating", "review", "image"]
 
+    def __init__(self):
+        self.writer = None
+        self.outputFile = None
+
+    def iter_elements(self, filename, tags):
+        # Stream elements from file, detaching elements from the document once the caller moves to the next one so
+        # memory usage does not depend on the size of the file. Elements still referenced by the caller are kept
+        for event, element in etree.iterparse(filename, events=("end",), tag=tags, remove_blank_text=True):
+            yield element
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def load_channels(self, filename):
+        logging.info("Parsing channels in {}".format(filename))
+        channels = 0
+        # Channels are listed before programmes so stop at the first programme
+        for element in self.iter_elements(filename=filename, tags=("channel", "programme")):
+            if element.tag == "programme":
+                break
+            channels += 1
+            yield element
+        logging.info("Found {} channels".format(channels))
+
+    def load_programmes(self, filename):
+        logging.info("Parsing programmes in {}".format(filename))
+        programmes = 0
+        for element in self.iter_elements(filename=filename, tags="programme"):
+            programmes += 1
+            yield element
+        logging.info("Found {} programmes".format(programmes))
+
+    def open_xmltv(self, filename):
+        self.outputFile = open(filename, "wb")
+        self.writer = self.xmltv_writer(xmlFileObj=self.outputFile)
+        next(self.writer)
+
+    def xmltv_writer(self, xmlFileObj):
+        # Write elements to file as they are received
+        with etree.xmlfile(xmlFileObj, encoding="utf-8") as xmlFile:
+            with xmlFile.element("tv"):
+                try:
+                    while True:
+                        element = (yield)
+                        etree.indent(element, level=1)
+                        xmlFile.write("\n  ")
+                        xmlFile.write(element)
+                except GeneratorExit:
+                    xmlFile.write("\n")
+
+    def write_element(self, element):
+        self.writer.send(element)
+
+    def save_xmltv(self):
+        self.writer.close()
+        self.outputFile.write(b"\n")
+        self.outputFile.close()
+
+    @timed("parse_element")
     def parse_element(self, element):
+        # Timed once per programme, subelements are parsed by parse_subelement
+        return self.parse_subelement(element=element)
+
+    def parse_subelement(self, element):
         record = collections.OrderedDict()
         # Get element attributes, add them to a list to preserve order
         if element.attrib:
@@ -266,54 +688,49 @@ class xmltv(object):
             for subElement in element.getchildren():
                 if subElement.tag not in record:
                     record[subElement.tag] = []
-                record[subElement.tag].append(self.parse_element(element=subElement))
+                record[subElement.tag].append(self.parse_subelement(element=subElement))
         return record
 
-    def build_programme_element(self, record):
-        element = self.build_element(record=record, elementName="programme")
-        self.programmes.append(element)
-
-    def build_element(self, record, elementName):
-        element = etree.Element(elementName)
-        #  Insert attributes
-        if "_attrib" in record:
-            for attribName, attribValue in record["_attrib"].items():
-                element.set(attribName, attribValue)
-        # Add text to element
-        if "_text" in record:
-            element.text = record["_text"]
-        # Add children
-        for childName, childValue in record.items():
-            if childName[0] == "_":
-                continue
-            for childValue in record[childName]:
-                subElement = self.build_element(record=childValue, elementName=childName)
-                element.append(subElement)
-        return element
-
-    def add_text_element(self, text, lang=None):
-        record = {}
-        record["_text"] = str(text)
+    def replace_elements(self, element, tag, newElements):
+        # Replace subelements in place, or insert them in the position defined by the XMLTV DTD if not present
+        existingElements = element.findall(tag)
+        if existingElements:
+            position = element.index(existingElements[0])
+            for existingElement in existingElements:
+                element.remove(existingElement)
+        else:
+            position = len(element)
+            if tag in self.programmeElements:
+                followingElements = self.programmeElements[self.programmeElements.index(tag) + 1:]
+                for index, subElement in enumerate(element):
+                    if subElement.tag in followingElements:
+                        position = index
+                        break
+        for index, newElement in enumerate(newElements):
+            element.insert(position + index, newElement)
+
+    def add_text_element(self, tag, text, lang=None):
+        element = etree.Element(tag)
+        element.text = str(text)
         if lang:
-            record["_attrib"] = {"lang": lang}
-        return record
+            element.set("lang", lang)
+        return element
 
-    def add_element_value_subelement(self, text):
-        record = []
-        record.append({"value": []})
-        record[0]["value"].append(self.add_text_element(text=text, lang=None))
-        return record
+    def add_element_value_subelement(self, tag, text):
+        element = etree.Element(tag)
+        element.append(self.add_text_element(tag="value", text=text, lang=None))
+        return element
 
     def add_episode_num_element(self, episodeNum):
-        record = {}
-        record["_text"] = episodeNum
-        record["_attrib"] = {"system": "onscreen"}
-        return record
+        element = etree.Element("episode-num")
+        element.text = episodeNum
+        element.set("system", "onscreen")
+        return element
 
     def add_icon_element(self, url):
-        record = {"_attrib": {}}
-        record["_attrib"]["src"] = url
-        return record
+        element = etree.Element("icon")
+        element.set("src", url)
+        return element
 
 if __name__ == "__main__":
     # Parse command line arguments
@@ -325,6 +742,13 @@ if __name__ == "__main__":
     required.add_argument("-o", "--output", type=str, help="Output XMLTV file")
     optional.add_argument("-l", "--logfile", type=str, help="Output log to file")
     optional.add_argument("-f", "--force", action="store_true", help="Force search for all movies")
+    optional.add_argument("-c", "--concurrency", type=int, default=8, help="Number of programmes to search concurrently (Default: 8)")
+    optional.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes (Default: 1)")
+    optional.add_argument("-m", "--categories", type=str, help="JSON file mapping categories to a programme type (movie, tvshow, documentary or ignore)")
+    optional.add_argument("-s", "--state", type=str, help="State file used to skip programmes unchanged since the previous run")
+    optional.add_argument("-t", "--state-ttl", type=int, default=24, help="Hours after which programmes in the state file are searched again (Default: 24)")
+    optional.add_argument("--metrics", type=str, help="Save a JSON report of calls, latencies and errors of each stage to file")
+    optional.add_argument("--prometheus", type=str, help="Save the metrics in Prometheus text format to file")
     optional.add_argument("-d", "--debug", action="store_true", help="Enable debug")
     args = argParser.parse_args()
 
@@ -338,10 +762,22 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logLevel, format="%(asctime)s %(message)s")
 
-    epg = epg(force=args.force)
-    # Process input files
-    for filename in args.input:
-        epg.process_file(filename)
-    # Save file
-    epg.save_file(args.output)
+    if args.workers > 1:
+        # Programmes are split across worker processes, each searching with the given concurrency
+        process_files_with_workers(inputFiles=args.input, outputFile=args.output, workers=args.workers, force=args.force,
+                                   concurrency=args.concurrency, categoriesFile=args.categories, logLevel=logLevel, logFile=args.logfile,
+                                   stateFile=args.state, stateTtl=args.state_ttl)
+    else:
+        epg = epg(force=args.force, concurrency=args.concurrency, categoriesFile=args.categories, stateFile=args.state, stateTtl=args.state_ttl)
+        # Output is written while input files are processed. All channels are written before the programmes
+        epg.open_file(args.output)
+        for filename in args.input:
+            epg.process_channels(filename)
+        # Process input files
+        for filename in args.input:
+            epg.process_file(filename)
+        # Save file
+        epg.save_file()
+        epg.log_stats()
+    save_metrics(metricsFile=args.metrics, prometheusFile=args.prometheus)
     logging.info("Done")